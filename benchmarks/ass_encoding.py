@@ -0,0 +1,89 @@
+"""Tokens per dialogue line of the .ass encodings: '{format N}' tokens with 'Name: ' on every line,
+the lean encoding, and the lean encoding with a speaker table per request.
+
+Tokens are counted with the gemini api when GEMINI_KEY is set, otherwise estimated at
+--chars-per-token characters per token. Each file is also checked to be rebuilt exactly
+from its lean dialogue.
+
+    python -m benchmarks.ass_encoding path/to/fansubs/*.ass
+"""
+import os
+import asyncio
+import argparse
+import tempfile
+
+from src.models import AssSettings, AssIgnore
+from src.ass_parser import AssTranslationFile
+from src.speaker_table import SpeakerTable
+from benchmarks.corpus import generate_ass
+from benchmarks.wire_format import count
+
+
+def requests(dialogue: list[str], lines_per_chunk: int, speaker_table: bool) -> list[str]:
+    texts = []
+    for i in range(0, len(dialogue), lines_per_chunk):
+        block = dialogue[i: i + lines_per_chunk]
+        speakers = SpeakerTable(block) if speaker_table else SpeakerTable()
+        texts.append(speakers.header() + '\n'.join(
+            f"Line {n} - {speakers.encode(line)}" for n, line in enumerate(block)))
+    return texts
+
+
+async def run(args, paths: list[str]) -> dict:
+    encodings = {"format tokens": (False, False), "lean": (True, False), "lean + speakers": (True, True)}
+    texts = {name: [] for name in encodings}
+    lines = 0
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as fp:
+            text = fp.read()
+        for name, (lean, speaker_table) in encodings.items():
+            settings = AssSettings(ignore=[AssIgnore(field='Effect', values=set(args.ignore_effects))], lean=lean)
+            sub = AssTranslationFile(text, settings)
+            if lean:
+                reference = AssTranslationFile(text, settings.model_copy(update={"lean": False}))
+                if sub.get_translation(sub.get_dialogue()) != reference.get_translation(reference.get_dialogue()):
+                    raise ValueError(f"{path}: lean encoding does not rebuild the file")
+            texts[name].extend(requests(sub.get_dialogue(), args.lines_per_chunk, speaker_table))
+        lines += len(sub.get_dialogue())
+
+    return {
+        "lines": lines,
+        "files": len(paths),
+        "encodings": {
+            name: {"chars": sum(len(t) for t in encoded), "tokens": await count(encoded, args)}
+            for name, encoded in texts.items()}}
+
+
+def report(result: dict, exact: bool):
+    lines = result['lines']
+    print(f"{lines} lines in {result['files']} files, tokens {'counted by gemini' if exact else 'estimated'}")
+    baseline = result['encodings']['format tokens']['tokens']
+    for name, r in result['encodings'].items():
+        print(
+            f"{name:>16}: {r['chars'] / lines:6.1f} chars/line {r['tokens'] / lines:6.1f} tok/line"
+            f" ({r['tokens'] / baseline - 1:+.0%})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='.ass files, synthetic karaoke and sign heavy ones are used if none')
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--lines', type=int, default=500)
+    parser.add_argument('--lines-per-chunk', type=int, default=500)
+    parser.add_argument('--ignore-effects', nargs='*', default=[], help='Effect values of the ignored lines, e.g. fx')
+    parser.add_argument('--chars-per-token', type=float, default=4.0)
+    parser.add_argument('--model', default='gemini-2.0-flash-lite')
+    args = parser.parse_args()
+    args.key = os.environ.get('GEMINI_KEY')
+
+    if args.paths:
+        result = asyncio.run(run(args, args.paths))
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            paths = []
+            for i in range(args.files):
+                paths.append(os.path.join(folder, f"synthetic_{i}.ass"))
+                with open(paths[-1], 'w', encoding='utf-8') as fp:
+                    fp.write(generate_ass(args.lines, i, karaoke_rate=0.2, sign_rate=0.2))
+            result = asyncio.run(run(args, paths))
+    report(result, args.key is not None)
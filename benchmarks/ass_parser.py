@@ -0,0 +1,110 @@
+""".ass parsing and writing time, and peak memory of the current parser against the parser of an
+earlier revision, loaded with git, on large synthetic karaoke and typesetting heavy scripts.
+The files written by both parsers are checked to be identical, peak memory is traced
+writing to a null file and includes the translated dialogue.
+
+    python -m benchmarks.ass_parser --lines 50000 --baseline-rev <git revision>
+    python -m benchmarks.ass_parser --baseline-rev $(git merge-base HEAD main) path/to/fansubs/*.ass
+"""
+import io
+import os
+import time
+import argparse
+import tracemalloc
+import subprocess
+import types
+
+from typing import Callable
+
+from src.models import AssSettings, AssIgnore, TranslationFile
+from src.ass_parser import AssTranslationFile
+from benchmarks.corpus import generate_ass
+
+
+def load_baseline(rev: str, module: str = 'ass_parser', name: str = 'AssTranslationFile') -> type:
+    path = f"src/{module}.py"
+    source = subprocess.run(['git', 'show', f"{rev}:{path}"], capture_output=True, text=True, check=True).stdout
+    baseline = types.ModuleType(f"baseline_{module}")
+    exec(compile(source, f"{rev}:{path}", 'exec'), baseline.__dict__)
+    return getattr(baseline, name)
+
+
+def write(sub, translation: list[str], fp, streaming: bool):
+    if streaming:
+        sub.write_translation(translation, fp)
+    else:
+        fp.write(sub.get_translation(translation))
+
+
+def measure(load: Callable[[str], TranslationFile], text: str, streaming: bool, repeat: int) -> dict:
+    """Best time of `repeat` runs, then peak memory traced in a separate run writing to a null file"""
+    result = {"parse": float('inf'), "write": float('inf')}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sub = load(text)
+        translation = [line.upper() for line in sub.get_dialogue()]
+        parsed = time.perf_counter()
+        out = io.StringIO()
+        write(sub, translation, out, streaming)
+        result["parse"] = min(result["parse"], parsed - start)
+        result["write"] = min(result["write"], time.perf_counter() - parsed)
+    result["output"] = out.getvalue()
+
+    del sub, out
+    tracemalloc.start()
+    sub = load(text)
+    translation = [line.upper() for line in sub.get_dialogue()]
+    result["parse_peak"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    with open(os.devnull, 'w', encoding='utf-8') as fp:
+        write(sub, translation, fp, streaming)
+    result["write_peak"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result
+
+
+def run(args, texts: list[str]) -> dict:
+    baseline = load_baseline(args.baseline_rev)
+    settings = AssSettings(ignore=[AssIgnore(field='Effect', values=set(args.ignore_effects))], lean=args.lean_ass)
+    result = {"baseline": [], "current": [], "chars": sum(len(t) for t in texts)}
+    for text in texts:
+        old = measure(lambda t: baseline(t, settings.model_copy(deep=True)), text, streaming=False, repeat=args.repeat)
+        new = measure(lambda t: AssTranslationFile(t, settings.model_copy(deep=True)), text, streaming=True, repeat=args.repeat)
+        if old.pop('output') != new.pop('output'):
+            raise ValueError("the parsers write different files")
+        result["baseline"].append(old)
+        result["current"].append(new)
+    return result
+
+
+def report(result: dict, rev: str):
+    print(f"{len(result['current'])} files, {result['chars'] / 2**20:.1f} MiB of text, outputs identical")
+    print(f"{'parser':>10} {'parse':>9} {'write':>9} {'parse peak':>12} {'write peak':>12}")
+    for name in ("baseline", "current"):
+        runs = result[name]
+        print(
+            f"{rev if name == 'baseline' else name:>10}"
+            f" {sum(r['parse'] for r in runs):8.3f}s {sum(r['write'] for r in runs):8.3f}s"
+            f" {max(r['parse_peak'] for r in runs) / 2**20:8.1f} MiB {max(r['write_peak'] for r in runs) / 2**20:8.1f} MiB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='.ass files, synthetic karaoke and sign heavy ones are used if none')
+    parser.add_argument(
+        '--baseline-rev', required=True, help='git revision of the parser to compare with, e.g. the merge base with main')
+    parser.add_argument('--files', type=int, default=3)
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs timed per file, the best one is kept')
+    parser.add_argument('--lean-ass', action='store_true')
+    parser.add_argument('--ignore-effects', nargs='*', default=['fx'], help='Effect values of the ignored lines')
+    args = parser.parse_args()
+
+    if args.paths:
+        texts = []
+        for path in args.paths:
+            with open(path, 'r', encoding='utf-8') as fp:
+                texts.append(fp.read())
+    else:
+        texts = [generate_ass(args.lines, i, karaoke_rate=0.3, sign_rate=0.3, layer_rate=0.5) for i in range(args.files)]
+    report(run(args, texts), args.baseline_rev)
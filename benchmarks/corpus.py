@@ -0,0 +1,110 @@
+"""Synthetic .ass and .srt subtitles for benchmarks"""
+import os
+import random
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 1920
+PlayResY: 1080
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,60,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,1,2,10,10,40,1
+Style: Sign,Arial,50,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,1,8,10,10,40,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+WORDS = (
+    "the captain said we sail at dawn and nobody will stop us now "
+    "I never thought I would see this island again where is everybody "
+    "run they are coming back with more ships than before hold on"
+).split()
+NAMES = ["Luffy", "Zoro", "Nami", "Usopp", "Sanji", ""]
+
+
+def _timestamp(seconds: float, ass: bool) -> str:
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    if ass:
+        return f"{int(h)}:{int(m):02}:{s:05.2f}"
+    return f"{int(h):02}:{int(m):02}:{int(s):02},{int((s % 1) * 1000):03}"
+
+
+def _sentence(rnd: random.Random) -> str:
+    return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 14))).capitalize()
+
+
+def generate_ass(
+        lines: int, seed: int = 0, karaoke_rate: float = 0.1, sign_rate: float = 0.1, layer_rate: float = 0.0) -> str:
+    """`layer_rate` of the signs are typeset again in 1 to 3 more layers with the same text"""
+    rnd = random.Random(seed)
+    events = []
+    for i in range(lines):
+        start, end = _timestamp(i * 2.5, True), _timestamp(i * 2.5 + 2, True)
+        r = rnd.random()
+        if r < karaoke_rate:
+            text = ''.join(f"{{\\k{rnd.randint(10, 60)}}}{w} " for w in _sentence(rnd).split())
+            events.append(f"Dialogue: 0,{start},{end},Default,,0,0,0,fx,{text}")
+        elif r < karaoke_rate + sign_rate:
+            x, y, sign = rnd.randint(0, 1920), rnd.randint(0, 1080), _sentence(rnd)
+            events.append(f"Dialogue: 1,{start},{end},Sign,,0,0,0,,{{\\an8\\pos({x},{y})\\fs50}}{sign}")
+            if layer_rate and rnd.random() < layer_rate:
+                for layer in range(rnd.randint(1, 3)):
+                    events.append(
+                        f"Dialogue: {layer + 2},{start},{end},Sign,,0,0,0,,"
+                        f"{{\\an8\\pos({x},{y})\\fs50\\bord{layer * 2 + 2}\\3c&H{layer * 40:02X}0000&}}{sign}")
+        else:
+            text = _sentence(rnd)
+            if rnd.random() < 0.3:
+                text = f"{{\\i1}}{text}{{\\i0}}"
+            if rnd.random() < 0.2:
+                text += f"\\N{_sentence(rnd)}"
+            events.append(f"Dialogue: 0,{start},{end},Default,{rnd.choice(NAMES)},0,0,0,,{text}")
+    return ASS_HEADER + '\n'.join(events) + '\n'
+
+
+def generate_srt(lines: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    blocks = []
+    for i in range(lines):
+        text = _sentence(rnd)
+        if rnd.random() < 0.2:
+            text += '\n' + _sentence(rnd)
+        blocks.append(f"{i + 1}\n{_timestamp(i * 2.5, False)} --> {_timestamp(i * 2.5 + 2, False)}\n{text}")
+    return '\n\n'.join(blocks)
+
+
+def write_corpus(
+        folder: str, files: int, min_lines: int, max_lines: int, seed: int = 0, layer_rate: float = 0.0) -> list[str]:
+    """Write `files` subtitles alternating .ass and .srt, return their paths"""
+    rnd = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(files):
+        lines = rnd.randint(min_lines, max_lines)
+        ext = '.ass' if i % 2 == 0 else '.srt'
+        text = generate_ass(lines, seed + i, layer_rate=layer_rate) if ext == '.ass' else generate_srt(lines, seed + i)
+        path = os.path.join(folder, f"episode_{i:05}{ext}")
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+        paths.append(path)
+    return paths
+
+
+def edit_corpus(paths: list[str], rate: float, seed: int = 0) -> int:
+    """Append a word to `rate` of the dialogue lines, as in a fixed release of the subtitles, return the lines edited"""
+    rnd = random.Random(seed)
+    edited = 0
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as fp:
+            lines = fp.read().split('\n')
+        for i, line in enumerate(lines):
+            dialogue = line.startswith('Dialogue:') if path.endswith('.ass') else i > 0 and '-->' in lines[i - 1]
+            if dialogue and rnd.random() < rate:
+                lines[i] = line + ' again'
+                edited += 1
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write('\n'.join(lines))
+    return edited
@@ -0,0 +1,77 @@
+"""Time to the first file, total time and peak memory to list the files to translate in a library of
+empty sub files, half of them already translated.
+
+The previous discovery, globbing a folder and filtering it against the list of outputs, runs on all the
+files in a single folder since it cannot recurse; lazy discovery runs both on the single folder and on
+the library split in show and season folders.
+
+    python -m benchmarks.discovery --files 20000
+"""
+import os
+import glob
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from typing import Callable, Iterable
+
+from src.discovery import translated_path, discover_files
+
+suffix = '_ita'
+
+def previous_discovery(folder: str) -> list[str]:
+    """Discovery of the entry point before it was lazy"""
+    folder = glob.escape(folder)
+    file_paths = glob.glob(f'{folder}/*.ass') + glob.glob(f'{folder}/*.srt')
+    translated = glob.glob(f'{folder}/*{suffix}.ass') + glob.glob(f'{folder}/*{suffix}.srt')
+    return [f for f in file_paths
+            if not f[:-4].endswith(suffix)
+            and translated_path(f, suffix) not in translated]
+
+def write_library(root: str, files: int, episodes: int, seasons: int, nested: bool):
+    for i in range(files):
+        show, episode = divmod(i, episodes * seasons)
+        season, episode = divmod(episode, episodes)
+        folder = os.path.join(root, f'show {show}', f'season {season + 1}') if nested else root
+        os.makedirs(folder, exist_ok=True)
+        name = f'show {show} s{season + 1:02}e{episode + 1:02}{".ass" if i % 3 else ".srt"}'
+        open(os.path.join(folder, name), 'w').close()
+        if i % 2:
+            open(translated_path(os.path.join(folder, name), suffix), 'w').close()
+
+def measure(discover: Callable[[], Iterable[str]]) -> dict:
+    tracemalloc.start()
+    begin = time.perf_counter()
+    first, found = None, 0
+    for _ in discover():
+        found += 1
+        if first is None: first = time.perf_counter() - begin
+    elapsed = time.perf_counter() - begin
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"found": found, "first": first or 0, "elapsed": elapsed, "peak": peak}
+
+def report(results: dict[str, dict]):
+    print(f"{'discovery':>18} {'files':>7} {'first file':>11} {'total':>9} {'peak memory':>12}")
+    for name, r in results.items():
+        print(
+            f"{name:>18} {r['found']:7} {r['first'] * 1000:9.1f}ms {r['elapsed']:8.2f}s"
+            f" {r['peak'] / 2**20:10.2f}MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--episodes', type=int, default=25, help='files per season folder')
+    parser.add_argument('--seasons', type=int, default=4, help='season folders per show')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as flat, tempfile.TemporaryDirectory() as nested:
+        write_library(flat, args.files, args.episodes, args.seasons, nested=False)
+        write_library(nested, args.files, args.episodes, args.seasons, nested=True)
+        results['previous, flat'] = measure(lambda: previous_discovery(flat))
+        results['lazy, flat'] = measure(lambda: discover_files([flat], suffix))
+        results['lazy, nested'] = measure(lambda: discover_files([nested], suffix, recursive=True))
+    report(results)
@@ -0,0 +1,84 @@
+"""Time the event loop spends logging the per request lines of a run: rendered one by one by the logger
+of an earlier revision, rendered in batches by the renderer thread, and written to the rotating log file only.
+
+Lines are logged by `--tasks` concurrent tasks, as the requests do, while a ticker task sleeps --tick
+seconds in a loop; the time it wakes up late is time the loop was busy rendering. The console renders
+to a null file as if it was a terminal.
+
+    python -m benchmarks.logger --lines 20000 --baseline-rev <git revision>
+"""
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+from typing import Callable
+
+from rich.console import Console
+
+from benchmarks.ass_parser import load_baseline
+import src.logger as logger
+
+
+async def ticker(tick: float, stalls: list[float]):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(tick)
+        stalls.append(max(time.perf_counter() - start - tick, 0))
+
+
+async def run(log: Callable[[str], None], lines: int, tasks: int, tick: float) -> dict:
+    async def request(task: int):
+        for i in range(task, lines, tasks):
+            log(f"episode_{task:05}.ass.{i}: calling Gemini")
+            await asyncio.sleep(0)
+
+    stalls: list[float] = []
+    monitor = asyncio.create_task(ticker(tick, stalls))
+    begin = time.perf_counter()
+    async with asyncio.TaskGroup() as tg:
+        for task in range(tasks):
+            tg.create_task(request(task))
+    logger.flush()
+    elapsed = time.perf_counter() - begin
+    monitor.cancel()
+
+    stalls.sort()
+    return {
+        "elapsed": elapsed,
+        "p99": stalls[int(len(stalls) * 0.99)] if stalls else 0,
+        "max": stalls[-1] if stalls else 0,
+    }
+
+
+def report(results: dict[str, dict], lines: int):
+    print(f"{'logger':>22} {'elapsed':>9} {'per line':>10} {'p99 stall':>10} {'max stall':>10}")
+    for name, r in results.items():
+        print(
+            f"{name:>22} {r['elapsed']:8.2f}s {r['elapsed'] / lines * 1e6:8.1f}us"
+            f" {r['p99'] * 1000:8.1f}ms {r['max'] * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--tick', type=float, default=0.001)
+    parser.add_argument(
+        '--baseline-rev', required=True, help='revision with the unbatched logger, e.g. the merge base with main')
+    args = parser.parse_args()
+
+    results = {}
+    with open(os.devnull, 'w') as null, tempfile.TemporaryDirectory() as folder:
+        baseline_info = load_baseline(args.baseline_rev, module='logger', name='info')
+        baseline_info.__globals__['console'] = Console(file=null, force_terminal=True, width=120)
+        results['previous'] = asyncio.run(run(baseline_info, args.lines, args.tasks, args.tick))
+
+        logger.console = Console(file=null, force_terminal=True, width=120)
+        results['batched'] = asyncio.run(run(logger.info, args.lines, args.tasks, args.tick))
+
+        logger.setup(os.path.join(folder, 'run.log'))
+        results['verbose, log file'] = asyncio.run(run(logger.verbose, args.lines, args.tasks, args.tick))
+        logger.close()
+    report(results, args.lines)
@@ -0,0 +1,95 @@
+"""Event loop stalls of translate_subs.main with file reading, parsing and writing on the event loop,
+in a thread pool and in a process pool, on a synthetic corpus against the local FakeGeminiClient.
+
+A ticker task sleeps --tick seconds in a loop, the time it wakes up late is time in which no api
+response, limiter wakeup or other callback could run.
+
+    python -m benchmarks.loop_stall --files 1000 --io loop processes
+"""
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+from datetime import timedelta
+
+from src.models import Config, AssSettings, AssIgnore
+from src.fake_gemini import FakeGeminiClient
+from src.rate_limiter import RateLimitedLLM
+from benchmarks.corpus import write_corpus
+from benchmarks.throughput import build_prompt
+from translate_subs import main
+import src.logger as logger
+
+
+async def ticker(tick: float, stalls: list[float]):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(tick)
+        stalls.append(max(time.perf_counter() - start - tick, 0))
+
+
+async def run(args, paths: list[str], io: str) -> dict:
+    config = Config(
+        original_language='english',
+        translate_to='italian',
+        outfile_suffix='_ita',
+        lines_per_chunk=args.lines_per_chunk,
+        requests_per_minutes=args.rpm,
+        ass_settings=AssSettings(ignore=[AssIgnore(field='Effect', values={'fx'})]),
+        resume_journal=False,
+        io_workers=0 if io == 'loop' else args.io_workers,
+        io_processes=io == 'processes')
+    client = FakeGeminiClient(prompt=build_prompt(config), latency='fixed', latency_mean=args.latency, seed=args.seed)
+    llm = RateLimitedLLM(client, args.rpm, config.token_per_minutes, config.max_retries, wait_window=timedelta(seconds=1))
+
+    stalls: list[float] = []
+    monitor = asyncio.create_task(ticker(args.tick, stalls))
+    begin = time.perf_counter()
+    await main(llm, paths, config)
+    elapsed = time.perf_counter() - begin
+    monitor.cancel()
+
+    stalls.sort()
+    return {
+        "elapsed": elapsed,
+        "stalled": sum(s for s in stalls if s > args.stall),
+        "p99": stalls[int(len(stalls) * 0.99)] if stalls else 0,
+        "max": stalls[-1] if stalls else 0,
+        "requests": client.stats.requests,
+    }
+
+
+def report(results: dict[str, dict], stall: float):
+    print(f"{'file io':>10} {'elapsed':>9} {f'stalls > {stall * 1000:.0f}ms':>16} {'p99 stall':>10} {'max stall':>10}")
+    for io, r in results.items():
+        print(
+            f"{io:>10} {r['elapsed']:8.1f}s {r['stalled']:15.2f}s"
+            f" {r['p99'] * 1000:8.1f}ms {r['max'] * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--min-lines', type=int, default=150)
+    parser.add_argument('--max-lines', type=int, default=900)
+    parser.add_argument('--io', nargs='+', choices=['loop', 'threads', 'processes'], default=['loop', 'threads', 'processes'])
+    parser.add_argument('--io-workers', type=int, default=1)
+    parser.add_argument('--lines-per-chunk', type=int, default=500)
+    parser.add_argument('--rpm', type=int, default=100, help='requests per 1 second window')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds of each fake request')
+    parser.add_argument('--tick', type=float, default=0.001)
+    parser.add_argument('--stall', type=float, default=0.01, help='lateness counted as a stall, seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logger.console.quiet = True
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        paths = write_corpus(folder, args.files, args.min_lines, args.max_lines, args.seed)
+        for io in args.io:
+            results[io] = asyncio.run(run(args, paths, io))
+            for p in os.listdir(folder):
+                if '_ita.' in p: os.remove(os.path.join(folder, p))
+    report(results, args.stall)
@@ -0,0 +1,104 @@
+"""Compare the event-driven RateLimitedLLM scheduler with the previous 2 seconds polling loop.
+
+Time is scaled down: a window of `--window` seconds polled every window/30 seconds
+reproduces the original 60s window polled every 2s.
+
+    python -m benchmarks.rate_limiter_idle --requests 60 --rpm 10 --window 3
+"""
+import asyncio
+import argparse
+import time
+
+from datetime import timedelta
+
+from src.models import TokenUsage
+from src.rate_limiter import RateLimitedLLM
+import src.logger as logger
+
+
+class SleepClient:
+    """Minimal client answering after a fixed latency"""
+    model = "bench"
+    prompt = ""
+    cached_prompt_tokens = 0
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def ask(self, question: str) -> tuple[str, TokenUsage]:
+        await asyncio.sleep(self.latency)
+        return question, None
+
+
+class PollingRateLimitedLLM(RateLimitedLLM):
+    """Previous scheduler: every waiter polls the window at a fixed interval"""
+
+    def __init__(self, *args, poll_interval: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poll_interval = poll_interval
+
+    def _wake_waiters(self):
+        pass
+
+    async def _acquire(self, request_id: str, tokens_n: int):
+        while True:
+            self._clean_window()
+            if self._can_start(tokens_n):
+                self._start(tokens_n)
+                return
+            await asyncio.sleep(self.poll_interval)
+
+
+async def run(llm: RateLimitedLLM, requests: int, window: float) -> dict:
+    starts: list[float] = []
+    begin = time.monotonic()
+
+    async def request(i: int):
+        await llm._acquire(str(i), 1)
+        starts.append(time.monotonic() - begin)
+        try:
+            await llm.client.ask("x")
+        finally:
+            llm._complete(1)
+
+    async with asyncio.TaskGroup() as tg:
+        for i in range(requests):
+            tg.create_task(request(i))
+
+    starts.sort()
+    # with all requests queued at once the k-th request can start as soon as the (k-rpm)-th completed window ago
+    ideal = [
+        0 if k < llm.rpm else starts[k - llm.rpm] + llm.client.latency + window
+        for k in range(requests)]
+    return {
+        "makespan": time.monotonic() - begin,
+        "idle": sum(max(s - i, 0) for s, i in zip(starts, ideal)),
+        "max_delay": max(max(s - i, 0) for s, i in zip(starts, ideal)),
+    }
+
+
+async def main(args):
+    window = timedelta(seconds=args.window)
+    schedulers = {
+        "polling": PollingRateLimitedLLM(
+            SleepClient(args.latency), args.rpm, 10**9, 0,
+            wait_window=window, poll_interval=args.window/30),
+        "event-driven": RateLimitedLLM(
+            SleepClient(args.latency), args.rpm, 10**9, 0, wait_window=window),
+    }
+    for name, llm in schedulers.items():
+        result = await run(llm, args.requests, args.window)
+        print(
+            f"{name:>13}: makespan {result['makespan']:.2f}s, "
+            f"idle {result['idle']:.2f}s over {args.requests} requests, "
+            f"worst admission delay {result['max_delay']*1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=60)
+    parser.add_argument('--rpm', type=int, default=10)
+    parser.add_argument('--window', type=float, default=3.0)
+    parser.add_argument('--latency', type=float, default=0.05)
+    logger.console.quiet = True
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,61 @@
+""".srt parsing and writing time, and peak memory of the current parser against the parser of an
+earlier revision, on large synthetic subtitles, plus the dialogue lines each parser extracts from
+the same subtitles saved with CRLF line endings and a BOM, and with extra blank lines.
+
+Broken lines differ from the dialogue of the block at their position, they would be sent for
+translation and the translated file would not match the original blocks.
+
+    python -m benchmarks.srt_parser --lines 200000 --baseline-rev <git revision>
+"""
+import argparse
+
+from itertools import zip_longest
+
+from src.srt_parser import SrtTranslationFile
+from benchmarks.corpus import generate_srt
+from benchmarks.ass_parser import load_baseline, measure, report
+
+
+def variants(text: str) -> dict[str, str]:
+    return {
+        "lf": text,
+        "crlf + bom": '\ufeff' + text.replace('\n', '\r\n') + '\r\n',
+        "blank lines": '\n' + text.replace('\n\n', '\n\n\n') + '\n\n',
+    }
+
+
+def run(args, texts: list[str]) -> dict:
+    baseline = load_baseline(args.baseline_rev, 'srt_parser', 'SrtTranslationFile')
+    result = {"baseline": [], "current": [], "chars": sum(len(t) for t in texts), "variants": {}}
+    for text in texts:
+        old = measure(baseline, text, streaming=False, repeat=args.repeat)
+        new = measure(SrtTranslationFile, text, streaming=True, repeat=args.repeat)
+        if old.pop('output') != new.pop('output'):
+            raise ValueError("the parsers write different files")
+        result["baseline"].append(old)
+        result["current"].append(new)
+
+        expected = SrtTranslationFile(text).get_dialogue()
+        for name, variant in variants(text).items():
+            counts = result["variants"].setdefault(name, {"lines": 0, "baseline": 0, "current": 0})
+            counts["lines"] += len(expected)
+            for parser in ("baseline", "current"):
+                dialogue = (baseline if parser == "baseline" else SrtTranslationFile)(variant).get_dialogue()
+                counts[parser] += sum(1 for a, b in zip_longest(dialogue, expected) if a != b)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--baseline-rev', required=True, help='git revision of the parser to compare with, e.g. the merge base with main')
+    parser.add_argument('--files', type=int, default=3)
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs timed per file, the best one is kept')
+    args = parser.parse_args()
+
+    result = run(args, [generate_srt(args.lines, i) for i in range(args.files)])
+    report(result, args.baseline_rev)
+    print(f"{'saved as':>12} {'lines':>8} {args.baseline_rev + ' broken':>16} {'current broken':>16}")
+    for name, counts in result["variants"].items():
+        print(f"{name:>12} {counts['lines']:>8} {counts['baseline']:>16} {counts['current']:>16}")
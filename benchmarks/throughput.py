@@ -0,0 +1,184 @@
+"""End-to-end throughput of translate_subs.main on a synthetic corpus, against the local FakeGeminiClient.
+
+Time is scaled by --time-scale: with 0.05 a minute of rate limits window lasts 3 seconds
+and api latencies are shortened by the same factor, files/min are reported in unscaled minutes.
+
+    python -m benchmarks.throughput --files 40 --translator json --rpm 15
+
+With --edit-rate, a fraction of the dialogue lines is edited after the run and the corpus is translated
+again, as an updated release, reporting the requests needed to retranslate only the changed lines.
+"""
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+from datetime import timedelta
+from string import Template
+
+from src.models import Config, AssSettings, AssIgnore, ModelLimits
+from src.fake_gemini import FakeGeminiClient
+from src.rate_limiter import RateLimitedLLM
+from src.discovery import is_translation
+from benchmarks.corpus import write_corpus, edit_corpus
+from translate_subs import main
+import src.logger as logger
+import src.telemetry as telemetry
+
+root = os.path.abspath(os.path.join(os.path.split(__file__)[0], '..'))
+
+
+def build_prompt(config: Config) -> str:
+    with (
+            open(os.path.join(root, 'user_prompt.md'), 'r') as user_prompt_fp,
+            open(os.path.join(root, 'system_prompt.md'), 'r') as system_prompt_fp):
+        return user_prompt_fp.read() + '\n' + Template(system_prompt_fp.read()).substitute(dict(config))
+
+
+async def run(args, folder: str) -> dict:
+    config = Config(
+        original_language='english',
+        translate_to='italian',
+        outfile_suffix='_ita',
+        translator_type=args.translator,
+        json_format=args.json_format,
+        speaker_table=args.speaker_table,
+        streaming=args.streaming,
+        lines_per_chunk=args.lines_per_chunk,
+        token_chunking=args.token_chunking,
+        adaptive_chunking=args.adaptive_chunking,
+        chunk_controller_path=args.chunk_controller_path,
+        model_limits={"fake": ModelLimits(output_tokens=args.max_output_tokens)} if args.max_output_tokens else {},
+        chunks_per_request=args.chunks_per_request,
+        requests_per_minutes=args.rpm,
+        token_per_minutes=args.tpm,
+        max_retries=args.max_retries,
+        ass_settings=AssSettings(ignore=[AssIgnore(field='Effect', values={'fx'})], lean=args.lean_ass),
+        resume_journal=False,
+        manifest=True, # the update after --edit-rate translates only the edited lines
+        dedup_lines=args.dedup_lines,
+        schedule_policy=args.schedule_policy)
+
+    paths = write_corpus(folder, args.files, args.min_lines, args.max_lines, args.seed, args.layer_rate)
+
+    client = FakeGeminiClient(
+        prompt=build_prompt(config),
+        latency=args.latency,
+        latency_mean=args.latency_mean * args.time_scale,
+        latency_spread=args.latency_spread * (args.time_scale if args.latency == 'uniform' else 1),
+        retriable_error_rate=args.error_rate,
+        retry_after=args.retry_after * args.time_scale if args.retry_after is not None else None,
+        drop_line_rate=args.drop_line_rate,
+        invalid_json_rate=args.invalid_json_rate,
+        cache_prompt=args.cache_prompt,
+        max_output_tokens=args.max_output_tokens,
+        seed=args.seed)
+    llm = RateLimitedLLM(
+        client, args.rpm, args.tpm, args.max_retries,
+        wait_window=timedelta(seconds=60 * args.time_scale),
+        backoff_base=2 * args.time_scale,
+        backoff_max=120 * args.time_scale)
+
+    begin, wall_begin = time.monotonic(), time.time()
+    await main(llm, paths, config)
+    elapsed = (time.monotonic() - begin) / args.time_scale
+
+    # seconds after the start at which each output file was written, unscaled
+    completions = sorted(
+        (os.path.getmtime(os.path.join(folder, p)) - wall_begin) / args.time_scale
+        for p in os.listdir(folder) if is_translation(p, '_ita'))
+    result = {
+        "files": len(paths),
+        "generated": len(completions),
+        "failed": telemetry.files_by_status.get("failed", 0),
+        "elapsed": elapsed,
+        "completions": completions,
+        "client": client.stats,
+        "limiter": llm.stats,
+    }
+
+    if args.edit_rate:
+        edited = edit_corpus(paths, args.edit_rate, args.seed)
+        requests = client.stats.requests
+        begin = time.monotonic()
+        await main(llm, paths, config)
+        result["update"] = {
+            "edited": edited,
+            "elapsed": (time.monotonic() - begin) / args.time_scale,
+            "requests": client.stats.requests - requests,
+            "failed": telemetry.files_by_status.get("failed", 0),
+        }
+    return result
+
+
+def report(result: dict, time_scale: float):
+    limiter, client = result['limiter'], result['client']
+    print(
+        f"generated {result['generated']}/{result['files']} files in {result['elapsed']:.1f}s (unscaled),"
+        f" {result['failed']} failed")
+    print(f"throughput: {result['generated'] / result['elapsed'] * 60:.2f} files/min")
+    if completions := result['completions']:
+        print(
+            f"files completed: first after {completions[0]:.1f}s, half after {completions[len(completions) // 2]:.1f}s,"
+            f" mean {sum(completions) / len(completions):.1f}s")
+    print(f"requests issued: {client.requests} ({limiter.retries} retries)")
+    print(
+        f"injected: {client.retriable_errors} retriable errors, {client.invalid_json} invalid json, "
+        f"{client.dropped_lines} dropped lines, {client.truncated} truncated responses")
+    print(
+        f"tokens: {limiter.reserved_tokens} reserved, {limiter.used_tokens} used "
+        f"({limiter.used_tokens / max(limiter.reserved_tokens, 1):.2f}x), {limiter.cached_tokens} cached")
+    print(f"backoffs: {limiter.backoffs}, {limiter.backoff_time / time_scale:.1f}s paused")
+    print(
+        f"rate limits: {limiter.idle / time_scale:.1f}s idle, "
+        f"{limiter.queue_wait / time_scale:.1f}s queue wait summed over requests")
+    if update := result.get('update'):
+        print(
+            f"update: {update['edited']} lines edited, translated again in {update['elapsed']:.1f}s"
+            f" with {update['requests']} requests, {update['failed']} files failed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=30)
+    parser.add_argument('--min-lines', type=int, default=150)
+    parser.add_argument('--max-lines', type=int, default=900)
+    parser.add_argument('--layer-rate', type=float, default=0.0, help='signs typeset again in more layers')
+    parser.add_argument('--translator', choices=['text', 'json'], default='text')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--json-format', choices=['chunks', 'compact'], default='chunks')
+    parser.add_argument('--lean-ass', action='store_true', help='lean encoding of .ass tags and speakers')
+    parser.add_argument('--speaker-table', action='store_true')
+    parser.add_argument('--dedup-lines', action='store_true')
+    parser.add_argument('--schedule-policy', choices=['fifo', 'shortest', 'deadline'], default='fifo')
+    parser.add_argument('--lines-per-chunk', type=int, default=500)
+    parser.add_argument('--token-chunking', action='store_true', help='size requests by the fake model token limits')
+    parser.add_argument('--adaptive-chunking', action='store_true')
+    parser.add_argument('--chunk-controller-path', help='keep the adaptive request size across benchmark runs')
+    parser.add_argument('--chunks-per-request', type=int, default=10)
+    parser.add_argument('--rpm', type=int, default=15)
+    parser.add_argument('--tpm', type=int, default=1000000)
+    parser.add_argument('--max-retries', type=int, default=2)
+    parser.add_argument('--latency', choices=['fixed', 'uniform', 'exponential', 'lognormal'], default='lognormal')
+    parser.add_argument('--latency-mean', type=float, default=8.0, help='seconds, unscaled')
+    parser.add_argument('--latency-spread', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, help='seconds suggested by injected errors, unscaled')
+    parser.add_argument('--drop-line-rate', type=float, default=0.0)
+    parser.add_argument('--invalid-json-rate', type=float, default=0.0)
+    parser.add_argument('--max-output-tokens', type=int, help='truncate longer responses, as the model output limit')
+    parser.add_argument('--cache-prompt', action='store_true', help='report the prompt as cached content')
+    parser.add_argument('--edit-rate', type=float, default=0.0, help='lines edited before translating the corpus again')
+    parser.add_argument('--time-scale', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', help='write the corpus and outputs to this folder instead of a temporary one')
+    args = parser.parse_args()
+
+    logger.console.quiet = True
+    if args.keep:
+        result = asyncio.run(run(args, args.keep))
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            result = asyncio.run(run(args, folder))
+    report(result, args.time_scale)
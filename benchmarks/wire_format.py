@@ -0,0 +1,103 @@
+"""Tokens per dialogue line of the json translator wire formats, requests and responses.
+
+Tokens are counted with the gemini api when GEMINI_KEY is set, otherwise estimated at
+--chars-per-token characters per token. Responses are approximated by the original lines
+in the response structure of each format.
+
+    python -m benchmarks.wire_format --files 10
+    GEMINI_KEY=... python -m benchmarks.wire_format path/to/subs/*.ass
+"""
+import os
+import json
+import asyncio
+import argparse
+import tempfile
+
+from src.models import AssSettings, AssIgnore, DialogueChunks
+from src.json_translator.chunker import ChunkedTranslation, split_chunks
+from src.json_translator.translator import prompt, compact_prompt
+from src.srt_parser import SrtTranslationFile
+from src.ass_parser import AssTranslationFile
+from benchmarks.corpus import write_corpus
+
+
+def load_dialogue(path: str) -> list[str]:
+    with open(path, 'r', encoding='utf-8') as fp:
+        if path.endswith('.ass'):
+            return AssTranslationFile(fp.read(), AssSettings(ignore=[AssIgnore(field='Effect', values={'fx'})])).get_dialogue()
+        return SrtTranslationFile(fp.read()).get_dialogue()
+
+
+def encode(chunks: DialogueChunks, wire_format: str, chunk_lines: int) -> tuple[str, str]:
+    """Request and approximated response of a block of chunks"""
+    if wire_format == "chunks":
+        return (
+            prompt.substitute(lines_per_chunk=chunk_lines, json=chunks.model_dump_json(indent=2)),
+            chunks.model_dump_json())
+    lines = json.dumps([c.dialogue for c in chunks.chunks], ensure_ascii=False)
+    return compact_prompt.substitute(json=lines), lines
+
+
+async def count(texts: list[str], args) -> int:
+    if not args.key:
+        return int(sum(len(t) for t in texts) / args.chars_per_token)
+    from src.gemini import GeminiClient
+    client = GeminiClient(key=args.key, model=args.model, prompt="")
+    return sum([await client.compute_question_tokens(t) for t in texts])
+
+
+async def run(args, paths: list[str]) -> dict:
+    blocks: list[DialogueChunks] = []
+    lines = 0
+    for path in paths:
+        dialogue = load_dialogue(path)
+        lines += len(dialogue)
+        blocks.extend(split_chunks(ChunkedTranslation(dialogue, args.lines_per_chunk).chunks, args.chunks_per_request))
+
+    result = {"lines": lines, "requests": len(blocks)}
+    for wire_format in ("chunks", "compact"):
+        encoded = [encode(b, wire_format, args.lines_per_chunk) for b in blocks]
+        result[wire_format] = {
+            "request_chars": sum(len(q) for q, _ in encoded),
+            "response_chars": sum(len(r) for _, r in encoded),
+            "request_tokens": await count([q for q, _ in encoded], args),
+            "response_tokens": await count([r for _, r in encoded], args),
+        }
+    return result
+
+
+def report(result: dict, exact: bool):
+    lines = result['lines']
+    print(f"{lines} lines in {result['requests']} requests, tokens {'counted by gemini' if exact else 'estimated'}")
+    print(f"{'format':>8} {'request':>16} {'response':>16} {'total':>10}")
+    for wire_format in ("chunks", "compact"):
+        r = result[wire_format]
+        print(
+            f"{wire_format:>8} {r['request_tokens'] / lines:>9.1f} tok/line {r['response_tokens'] / lines:>7.1f} tok/line"
+            f" {(r['request_tokens'] + r['response_tokens']) / lines:>5.1f} tok/line")
+    chunks, compact = result['chunks'], result['compact']
+    saved = 1 - (compact['request_tokens'] + compact['response_tokens']) / (chunks['request_tokens'] + chunks['response_tokens'])
+    print(f"compact saves {saved:.0%} of the tokens, {1 / (1 - saved):.2f}x lines under the same token_per_minutes")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help='.ass or .srt files, a synthetic corpus is used if none')
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--min-lines', type=int, default=150)
+    parser.add_argument('--max-lines', type=int, default=900)
+    parser.add_argument('--lines-per-chunk', type=int, default=50)
+    parser.add_argument('--chunks-per-request', type=int, default=10)
+    parser.add_argument('--chars-per-token', type=float, default=4.0)
+    parser.add_argument('--model', default='gemini-2.0-flash-lite')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.key = os.environ.get('GEMINI_KEY')
+
+    if args.paths:
+        result = asyncio.run(run(args, args.paths))
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            paths = write_corpus(folder, args.files, args.min_lines, args.max_lines, args.seed)
+            result = asyncio.run(run(args, paths))
+    report(result, args.key is not None)
@@ -1,73 +1,84 @@
 import re
+import io
 
-from typing import ClassVar
+from array import array
+from typing import ClassVar, TextIO, Optional
 
 from src.models import TranslationFile, AssSettings
 
 class AssTranslationFile(TranslationFile):
     command_regex: ClassVar[re.Pattern] = re.compile(r'\{[^{}]+\}')
+    edges_regex: ClassVar[re.Pattern] = re.compile(r'((?:\{[^{}]+\})*)(.*?)((?:\{[^{}]+\})*)', re.DOTALL)
+    marker_regex: ClassVar[re.Pattern] = re.compile(r'\{(\d+)\}')
+    line_regex: ClassVar[re.Pattern] = re.compile(r'[^\n]+')
+    nonblank_regex: ClassVar[re.Pattern] = re.compile(r'\S')
 
     def __init__(self, text: str, settings: AssSettings):
-        splitted = text.strip().split('[Events]', 1)
-        if len(splitted) == 1: raise ValueError("Invalid .ass format, [Events] tag not found")
-        subs = [s for s in splitted[1].split('\n') if s.strip()]
-        if not subs[0].strip().lower().startswith('format'): raise ValueError("Invalid .ass format, 'Format:' line not found")
-        self._header = splitted[0] + '[Events]\n' + subs[0] # from start to 'Format:...' line included
+        # events are not copied out of the text, only their offsets are kept
+        self._text = text
+        begin, end = len(text) - len(text.lstrip()), len(text.rstrip())
+        events = text.find('[Events]', begin, end)
+        if events == -1: raise ValueError("Invalid .ass format, [Events] tag not found")
+
+        lines = (
+            m.span() for m in self.line_regex.finditer(text, events + len('[Events]'), end)
+            if self.nonblank_regex.search(text, *m.span()))
+        format_start, format_end = next(lines, (end, end))
+        format_line = text[format_start:format_end]
+        if not format_line.strip().lower().startswith('format'): raise ValueError("Invalid .ass format, 'Format:' line not found")
+        self._header = text[begin:events] + '[Events]\n' + format_line # from start to 'Format:...' line included
+        self._header_lines = self._header.count('\n') + 1
         self._format = {
             s.strip().lower(): i
-            for i, s in enumerate(subs[0].replace('Format:', '').split(','))
+            for i, s in enumerate(format_line.replace('Format:', '').split(','))
         }
 
         self._name_i = self._format.get('name')
 
-        for rule in settings.ignore:
-            rule._field_i = self._format.get(rule.field.lower()) # maps field name to field position
-        self._ignore = [r for r in settings.ignore if r._field_i is not None]
+        # match group of the field of each rule, settings are shared by the files parsed in parallel and left untouched
+        self._ignore = [
+            (self._format[r.field.lower()] + 1, r.values) for r in settings.ignore if r.field.lower() in self._format]
 
         # .ass format commands '{...}' are replaced with dummy tokens '{format 1}' to simplify dialogue for translation
         self._commands: dict[str, str] = {} # maps dummy tokens to original commands for final restore
 
-        self._ignored: list[str] = [] # ignored lines
-        self._ignored_i: list[int] = [] # ignored line numbers
-
-        sections = self._apply_ignores(subs[1:])
-
-        self._fields: list[str] = [
-            f"{line[0]}:" + ','.join(line[1:len(self._format)]) for line in sections]
-
-        compose_line = (
-            lambda line: f"{line[self._name_i + 1] or 'Unknown'}: {line[-1]}"
-            if self._name_i is not None
-            else lambda line: line[-1]
-        )
-
-        self._dialogue: list[str] = [
-            self.command_regex.sub(self._sub_commands, compose_line(line))
-            for line in sections]
-
-
-    def _apply_ignores(self, lines: list[str]) -> list[list[str]]:
-        subs = []
-        for i, l in enumerate(lines):
-            ignored = True
-            splitted = l.split(':', 1)
-            if len(splitted) == 2 and splitted[0].strip().lower() == 'dialogue':
-                event, value = splitted
-                fields = value.split(',', len(self._format)-1)
-                if len(fields) == len(self._format) and fields[-1].strip():
-                    ignored = False
-                    for rule in self._ignore:
-                        if fields[rule._field_i].strip() in rule.values:
-                            ignored = True
-                            break
-
-            if ignored:
+        # lean encoding: commands at the start and end of a line are removed and reapplied by position,
+        # the ones in between are replaced with per line markers '{1}', unnamed lines have no speaker prefix
+        self._lean = settings.lean
+        self._edges: list[tuple[str, str]] = [] # leading and trailing commands of each line
+        self._line_commands: list[list[str]] = [] # commands replaced by the markers of each line
+        self._named: list[bool] = [] # lines with a speaker prefix
+
+        self._starts = array('q') # offsets of the event lines
+        self._ends = array('q')
+        self._dialogue_i = array('q') # event line of each dialogue line
+        self._text_starts = array('q') # offset of the text field of each dialogue line
+        self._ignored_i = array('q') # ignored line numbers
+
+        self._dialogue: list[str] = []
+        # a dialogue event with all its fields and a non blank text, one group per field
+        event_regex = re.compile(
+            r'\s*dialogue\s*:' + r'([^,\n]*),' * (len(self._format) - 1) + r'([^\n]*\S[^\n]*)', re.IGNORECASE)
+        text_group = len(self._format)
+        name_group = self._name_i + 1 if self._name_i is not None else None
+        for i, (start, end) in enumerate(lines):
+            self._starts.append(start)
+            self._ends.append(end)
+            m = event_regex.match(text, start, end)
+            if m is None or any(m.group(g).strip() in values for g, values in self._ignore):
                 self._ignored_i.append(i)
-                self._ignored.append(l)
-            else:
-                subs.append([event] + fields)
+                continue
 
-        return subs
+            self._dialogue_i.append(i)
+            self._text_starts.append(m.start(text_group))
+            self._dialogue.append(self._encode_line(m.group(name_group) if name_group else None, m.group(text_group)))
+
+    def _encode_line(self, name: str, text: str) -> str:
+        if self._lean:
+            return self._lean_line(name, text)
+        if self._name_i is not None:
+            text = f"{name or 'Unknown'}: {text}"
+        return self.command_regex.sub(self._sub_commands, text)
 
     def _sub_commands(self, m: re.Match) -> str:
         token = f"{{format {len(self._commands)}}}"
@@ -77,11 +88,44 @@ class AssTranslationFile(TranslationFile):
     def _restore_commands(self, m: re.Match) -> str:
         return self._commands.get(m.group(0), '{}')
 
+    def _lean_line(self, name: str, text: str) -> str:
+        leading, text, trailing = self.edges_regex.fullmatch(text).groups()
+        commands = []
+        def sub_marker(m: re.Match) -> str:
+            commands.append(m.group(0))
+            return f"{{{len(commands)}}}"
+        text = self.command_regex.sub(sub_marker, text)
+
+        self._edges.append((leading, trailing))
+        self._line_commands.append(commands)
+        name = name.strip() if name else ''
+        self._named.append(bool(name))
+        return f"{name}: {text}" if name else text
+
+    def _restore_lean_line(self, i: int, line: str) -> str:
+        if self._named[i]:
+            line = line.split(': ', 1)[-1]
+        commands = self._line_commands[i]
+        line = self.marker_regex.sub(
+            lambda m: commands[int(m.group(1)) - 1] if 0 < int(m.group(1)) <= len(commands) else '{}', line)
+        leading, trailing = self._edges[i]
+        return leading + line + trailing
+
+    def _restore_line(self, i: int, line: str) -> str:
+        if self._lean:
+            return self._restore_lean_line(i, line)
+        if self._name_i is not None:
+            line = line.split(': ', 1)[-1]
+        return self.command_regex.sub(self._restore_commands, line)
+
     def get_dialogue(self):
         return self._dialogue
 
+    def get_texts(self) -> list[str]:
+        text, ends, dialogue_i = self._text, self._ends, self._dialogue_i
+        return [text[start:ends[dialogue_i[j]]] for j, start in enumerate(self._text_starts)]
+
     def map_dialogue_lines(self, lines: list[int]) -> list[int]:
-        offset = self._header.count('\n') + 1
         final = []
         i = 0
         for l in lines:
@@ -89,23 +133,30 @@ class AssTranslationFile(TranslationFile):
             while  i < len(self._ignored_i) and self._ignored_i[i] <= t:
                 i += 1
                 t += 1
-            final.append(offset + t)
+            final.append(self._header_lines + t)
         return final
 
+    def write_translation(
+            self, translation: list[str], fp: TextIO, texts: list[Optional[str]] = None, buffer_lines: int = 1000):
+        """Write the final file to fp, buffer_lines lines at a time, without building it in memory"""
+        if len(self._dialogue) != len(translation): raise Exception("Lines count mismatch")
+        text, starts, ends, text_starts = self._text, self._starts, self._ends, self._text_starts
+        fp.write(self._header)
+        dialogue_i = iter(enumerate(self._dialogue_i))
+        j, next_dialogue = next(dialogue_i, (None, -1))
+        for first in range(0, len(starts), buffer_lines):
+            pieces = ['']
+            for i in range(first, min(first + buffer_lines, len(starts))):
+                if i == next_dialogue:
+                    kept = texts[j] if texts else None
+                    pieces.append(text[starts[i]:text_starts[j]] + (
+                        self._restore_line(j, translation[j]) if kept is None else kept))
+                    j, next_dialogue = next(dialogue_i, (None, -1))
+                else:
+                    pieces.append(text[starts[i]:ends[i]])
+            fp.write('\n'.join(pieces))
+
     def get_translation(self, translation: list[str]):
-        if len(self._fields) != len(translation): raise Exception("Lines count mismatch")
-        if self._name_i is not None:
-            translation = [line.split(': ', 1)[-1] for line in translation]
-        lines = [
-            f"{f},{self.command_regex.sub(self._restore_commands, l)}"
-            for f, l in zip(self._fields, translation)]
-        final = []
-        j = h = 0
-        for i in range(len(self._ignored) + len(lines)) :
-            if j < len(self._ignored) and i == self._ignored_i[j]:
-                final.append(self._ignored[j])
-                j += 1
-            else:
-                final.append(lines[h])
-                h += 1
-        return  '\n'.join([self._header] + final)
\ No newline at end of file
+        out = io.StringIO()
+        self.write_translation(translation, out)
+        return out.getvalue()
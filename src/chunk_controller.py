@@ -0,0 +1,82 @@
+from dataclasses import dataclass, asdict
+
+from src.keyed_json import load_keyed, save_keyed
+import src.logger as logger
+
+
+@dataclass
+class ChunkStats:
+    size: float
+    requests: int = 0
+    failures: int = 0
+    latency: float = None # smoothed seconds per request
+
+    @property
+    def failure_rate(self) -> float:
+        return self.failures / self.requests if self.requests else 0.0
+
+
+class ChunkSizeController:
+    """Tune the size of the requests at runtime, additive increase and multiplicative decrease.
+
+    Every request that comes back aligned and within `latency_target` seconds grows the size by
+    `increase`, a misaligned, truncated or unparsable one cuts it by `decrease`, as does a slow one.
+    The size stays between `minimum` and `maximum`, in the unit of the translator (lines or chunks),
+    and is kept separately for each key (model and translator), optionally persisted to a json file
+    so that the next run starts from what was learned.
+    """
+
+    def __init__(
+            self,
+            maximum: int,
+            minimum: int = None,
+            key: str = "default",
+            path: str = None,
+            increase: float = None,
+            decrease: float = 0.7,
+            latency_target: float = None,
+            smoothing: float = 0.2):
+        self.maximum = maximum
+        self.minimum = minimum or max(1, maximum // 10)
+        self.key = key
+        self.path = path
+        self.increase = increase or max(1, maximum / 20)
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.smoothing = smoothing
+
+        saved = load_keyed(path)
+        self.stats = ChunkStats(**saved[key]) if key in saved else ChunkStats(size=maximum)
+        self.stats.size = min(max(self.stats.size, self.minimum), self.maximum)
+
+    @property
+    def size(self) -> int:
+        return int(self.stats.size)
+
+    def record(self, size: int, success: bool, latency: float = None):
+        """Update the size with the outcome of a request of `size` lines or chunks"""
+        s = self.stats
+        s.requests += 1
+        if latency is not None:
+            s.latency = latency if s.latency is None else s.latency + self.smoothing * (latency - s.latency)
+        slow = self.latency_target is not None and latency is not None and latency > self.latency_target
+
+        s.failures += not success
+
+        # only requests of about the current size tell something about it: larger ones were sent
+        # before a reduction, smaller ones are tails of files or splits of failed requests
+        if not s.size / 2 <= size <= s.size:
+            return
+        if not success or slow:
+            previous = s.size
+            s.size = max(s.size * self.decrease, self.minimum)
+            logger.debug(
+                f"{self.key}: request size reduced from {int(previous)} to {int(s.size)}"
+                f" after a {'slow' if success else 'failed'} request")
+        else:
+            s.size = min(s.size + self.increase, self.maximum)
+
+    def save(self):
+        """Save the size learned under this controller key"""
+        if self.path:
+            save_keyed(self.path, self.key, asdict(self.stats))
@@ -0,0 +1,94 @@
+import time
+import asyncio
+
+from datetime import timedelta
+
+from rich.console import Console, Group
+from rich.live import Live
+from rich.progress_bar import ProgressBar
+from rich.table import Table
+from rich.text import Text
+
+from src.rate_limiter import RateLimitedLLM
+import src.telemetry as telemetry
+
+
+def _duration(seconds: float) -> str:
+    return str(timedelta(seconds=int(seconds)))
+
+class Dashboard:
+    """Live view of the run below the log lines: the files being translated with their progress, the
+    rate limits budget in use for each backend and the estimated time left.
+
+    It is redrawn from the event loop every `refresh` seconds by `run`, so it reads the limiters and the
+    telemetry records without racing the requests. Only the first `max_rows` open files are listed.
+    """
+
+    def __init__(self, backends: list[RateLimitedLLM], console: Console, refresh: float = 1.0, max_rows: int = 15):
+        self.backends = backends
+        self.console = console
+        self.refresh = refresh
+        self.max_rows = max_rows
+        self.discovery_done = False # no more files to translate than the open ones
+
+    def _files(self, files: list[telemetry.FileRecord]) -> Table:
+        table = Table(box=None, expand=True, show_edge=False)
+        table.add_column("File", ratio=3, no_wrap=True, overflow="ellipsis")
+        table.add_column("Progress", ratio=2)
+        table.add_column("Lines", justify="right")
+        table.add_column("Requests", justify="right")
+        table.add_column("Retries", justify="right")
+        table.add_column("Elapsed", justify="right")
+        now = time.time()
+        for file in files[:self.max_rows]:
+            table.add_row(
+                file.file,
+                ProgressBar(total=max(file.lines, 1), completed=min(file.translated_lines, file.lines)),
+                f"{min(file.translated_lines, file.lines)}/{file.lines}",
+                str(file.requests),
+                str(file.retries),
+                _duration(now - file.started) if file.started else '')
+        if len(files) > self.max_rows:
+            table.add_row(f"... {len(files) - self.max_rows} more", style="grey50")
+        return table
+
+    def _budget(self) -> Table:
+        table = Table(box=None, expand=True, show_edge=False)
+        table.add_column("Backend", ratio=3, no_wrap=True)
+        table.add_column("Requests", ratio=2)
+        table.add_column("Tokens", ratio=2)
+        table.add_column("Waiting", justify="right")
+        now = time.monotonic()
+        for backend in self.backends:
+            requests, tokens, waiting = backend.usage()
+            paused = backend.paused_until - now
+            table.add_row(
+                backend.model + (f" (paused {paused:.0f}s)" if paused > 0 else ''),
+                ProgressBar(total=1, completed=min(requests, 1)),
+                ProgressBar(total=1, completed=min(tokens, 1)),
+                str(waiting))
+        return table
+
+    def _status(self, files: list[telemetry.FileRecord]) -> Text:
+        elapsed = time.monotonic() - telemetry.started()
+        done = sum(telemetry.files_by_status.values())
+        failed = telemetry.files_by_status.get("failed", 0)
+        rate = telemetry.totals.translated_lines / elapsed if elapsed > 0 else 0
+        left = sum(max(f.lines - f.translated_lines, 0) for f in files)
+        eta = _duration(left / rate) if rate > 0 else '-'
+        if not self.discovery_done:
+            eta += " for the open files"
+        return Text(
+            f"{done} files done, {failed} failed, {len(files)} open - {rate * 60:.0f} lines/min"
+            f" - elapsed {_duration(elapsed)} - ETA {eta}", style="bold")
+
+    def render(self) -> Group:
+        files = telemetry.open_files()
+        return Group(self._files(files), Text(''), self._budget(), self._status(files))
+
+    async def run(self):
+        """Redraw the dashboard until cancelled, then remove it"""
+        with Live(self.render(), console=self.console, auto_refresh=False, transient=True) as live:
+            while True:
+                await asyncio.sleep(self.refresh)
+                live.update(self.render(), refresh=True)
@@ -0,0 +1,55 @@
+import re
+
+token_regex = re.compile(r'\{[^{}]*\}')
+
+class DialogueDedup:
+    """Collapse the repeated lines of a dialogue, to translate each of them once.
+
+    Lines are compared normalized: whitespace collapsed and the format tokens of the parsers
+    ignored, so that the same sign typeset in several layers matches even if each layer has
+    its own tokens. Unique lines keep the order of their first occurrence, which keeps its
+    surrounding lines as context, and translations are expanded back to every occurrence with
+    the occurrence's own tokens.
+    """
+
+    def __init__(self, dialogue: list[str]):
+        self.dialogue = dialogue
+        self.unique: list[str] = []
+        self._first: list[int] = [] # first occurrence of each unique line
+        self._unique_i: list[int] = [] # unique line of each line
+
+        keys: dict[str, int] = {}
+        for i, line in enumerate(dialogue):
+            key = self.normalize(line)
+            if key not in keys:
+                keys[key] = len(self.unique)
+                self.unique.append(line)
+                self._first.append(i)
+            self._unique_i.append(keys[key])
+
+    @staticmethod
+    def normalize(line: str) -> str:
+        return ' '.join(token_regex.sub('{}', line).split())
+
+    @property
+    def duplicates(self) -> int:
+        return len(self.dialogue) - len(self.unique)
+
+    @staticmethod
+    def _retoken(source: str, line: str, translation: str) -> str:
+        """Replace the tokens of the source line with the ones of its duplicate, by position"""
+        if source == line:
+            return translation
+        tokens = dict(zip(token_regex.findall(source), token_regex.findall(line)))
+        return token_regex.sub(lambda m: tokens.get(m.group(0), m.group(0)), translation)
+
+    def expand(self, translated: list[str]) -> list[str]:
+        return [
+            self._retoken(self.unique[u], line, translated[u])
+            for line, u in zip(self.dialogue, self._unique_i)]
+
+    def expand_ranges(self, ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        """Map ranges of unique lines, end excluded, to ranges of the full dialogue"""
+        def position(u: int) -> int:
+            return self._first[u] if u < len(self._first) else len(self.dialogue)
+        return [(position(a), position(b)) for a, b in ranges]
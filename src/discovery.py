@@ -0,0 +1,61 @@
+import os
+
+from typing import Iterable, Iterator
+
+from src.manifest import manifest_extension, source_changed
+
+extensions = ('.ass', '.srt')
+
+def translated_path(file_path: str, suffix: str) -> str:
+    path, file = os.path.split(file_path)
+    filename, ext = os.path.splitext(file)
+    out_file_name = f'{filename}{suffix}{ext}'
+    full_path = os.path.join(path, out_file_name)
+    return full_path
+
+def is_translation(file_path: str, suffix: str) -> bool:
+    """Whether the file was generated by the script"""
+    return os.path.splitext(file_path)[0].endswith(suffix)
+
+def _scan_folder(folder: str, suffix: str, recursive: bool, manifest: bool) -> Iterator[str]:
+    pending = [folder]
+    while pending:
+        current = pending.pop()
+        names, manifests, subfolders = [], set(), []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.name.endswith(extensions) and entry.is_file():
+                        names.append(entry.name)
+                    elif manifest and entry.name.endswith(manifest_extension):
+                        manifests.add(entry.name)
+                    elif recursive and entry.is_dir(follow_symlinks=False): # no symlink loops
+                        subfolders.append(entry.path)
+        except OSError:
+            if current == folder: raise
+            continue # unreadable subfolder
+
+        # outputs are looked up by name, only the names of the current folder are kept in memory
+        translated = {name for name in names if is_translation(name, suffix)}
+        for name in sorted(names):
+            if name in translated:
+                continue
+            out_name = translated_path(name, suffix)
+            if out_name not in translated or (
+                    out_name + manifest_extension in manifests
+                    and source_changed(os.path.join(current, name), os.path.join(current, out_name))):
+                yield os.path.join(current, name)
+        pending.extend(sorted(subfolders, reverse=True))
+
+def discover_files(
+        paths: Iterable[str], suffix: str, recursive: bool = False, manifest: bool = False) -> Iterator[str]:
+    """Yield the sub files to translate among `paths` and the content of the folders in `paths`,
+    one folder at a time. Files generated by the script are skipped, and so are the files already
+    translated, unless `manifest` is set and they changed since their translation."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _scan_folder(path, suffix, recursive, manifest)
+        elif path.endswith(extensions) and not is_translation(path, suffix):
+            out_path = translated_path(path, suffix)
+            if not os.path.exists(out_path) or (manifest and source_changed(path, out_path)):
+                yield path
@@ -0,0 +1,191 @@
+import re
+import json
+import random
+import asyncio
+
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from src.gemini import Structure
+from src.models import RetriableException, InvalidJsonException, TokenUsage
+
+record_regex = re.compile(r'(?:^|\n)Line\s+(\d+)\s*-\s?')
+format_regex = re.compile(r'(\{[^{}]*\}|<[^<>]*>)|([^{}<>]+)')
+
+def fake_translate(line: str) -> str:
+    """Deterministic stand-in translation: uppercase everything outside of {...} and <...> tags"""
+    return format_regex.sub(lambda m: m.group(1) or m.group(2).upper(), line)
+
+@dataclass
+class FakeStats:
+    requests: int = 0
+    retriable_errors: int = 0
+    invalid_json: int = 0
+    dropped_lines: int = 0
+    truncated: int = 0
+
+class FakeGeminiClient:
+    """Local GeminiClient stand-in to run the pipeline without calling the api.
+
+    Answers with deterministic translations after a random latency and can inject the failures seen
+    with the real api: RESOURCE_EXHAUSTED/UNAVAILABLE errors (suggesting `retry_after` seconds
+    before retrying), dropped lines and unparsable json.
+    `drop_line_rate` is the probability of a line missing from a text response or from a json chunk,
+    token usage is simulated as `chars_per_token` characters per token and streamed responses are
+    yielded in pieces of `stream_piece` characters.
+    Answers longer than `max_output_tokens` are truncated, text ones are cut and json ones fail to parse.
+    With `cache_prompt` the prompt is reported as cached content, as with GeminiClient context caching.
+    """
+
+    def __init__(self,
+            model: str = "fake",
+            prompt: str = "",
+            config: dict = None,
+            latency: str = "fixed",
+            latency_mean: float = 1.0,
+            latency_spread: float = 0.0,
+            retriable_error_rate: float = 0.0,
+            retry_after: float = None,
+            drop_line_rate: float = 0.0,
+            invalid_json_rate: float = 0.0,
+            chars_per_token: float = 3.5,
+            stream_piece: int = 64,
+            cache_prompt: bool = False,
+            max_output_tokens: int = None,
+            seed: int = None):
+        self.model = model
+        self.prompt = prompt
+        self.config = config or {}
+
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_spread = latency_spread
+        self.retriable_error_rate = retriable_error_rate
+        self.retry_after = retry_after
+        self.drop_line_rate = drop_line_rate
+        self.invalid_json_rate = invalid_json_rate
+        self.chars_per_token = chars_per_token
+        self.stream_piece = stream_piece
+        self.cache_prompt = cache_prompt
+        self.max_output_tokens = max_output_tokens
+
+        self.stats = FakeStats()
+        self._random = random.Random(seed)
+
+    def _sample_latency(self) -> float:
+        match self.latency:
+            case "fixed":
+                return self.latency_mean
+            case "uniform":
+                return self._random.uniform(
+                    max(self.latency_mean - self.latency_spread, 0), self.latency_mean + self.latency_spread)
+            case "exponential":
+                return self._random.expovariate(1 / self.latency_mean)
+            case "lognormal": # latency_spread is the sigma of the underlying normal
+                return self._random.lognormvariate(0, self.latency_spread) * self.latency_mean
+            case _:
+                raise ValueError(f"Unknown latency distribution {self.latency}")
+
+    def _tokens(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token)
+
+    @property
+    def cached_prompt_tokens(self) -> int:
+        return self._tokens(self.prompt) if self.cache_prompt else 0
+
+    async def release_cache(self):
+        pass
+
+    async def _respond(self, latency: float):
+        self.stats.requests += 1
+        await asyncio.sleep(latency)
+        if self._random.random() < self.retriable_error_rate:
+            self.stats.retriable_errors += 1
+            raise RetriableException(
+                self._random.choice(['RESOURCE_EXHAUSTED', 'UNAVAILABLE']), self.retry_after)
+
+    def _usage(self, question: str, answer: str) -> TokenUsage:
+        return TokenUsage(
+            prompt_tokens=self._tokens(self.prompt + '\n' + question),
+            output_tokens=self._tokens(answer),
+            cached_tokens=self.cached_prompt_tokens)
+
+    def _truncated(self, answer: str) -> bool:
+        truncated = self.max_output_tokens is not None and self._tokens(answer) > self.max_output_tokens
+        self.stats.truncated += truncated
+        return truncated
+
+    def _drop_line(self) -> bool:
+        dropped = self._random.random() < self.drop_line_rate
+        self.stats.dropped_lines += dropped
+        return dropped
+
+    def _text_answer(self, question: str) -> str:
+        # the numbered dialogue follows the last blank line of the question
+        parts = record_regex.split(question.rsplit('\n\n', 1)[-1])
+        lines = [(parts[i], fake_translate(parts[i + 1])) for i in range(1, len(parts), 2)]
+        if lines and self._drop_line():
+            lines.pop(self._random.randrange(len(lines)))
+        answer = '\n'.join(f"Line {n} - {text}" for n, text in lines)
+        if self._truncated(answer):
+            answer = answer[:int(self.max_output_tokens * self.chars_per_token)]
+        return answer
+
+    async def ask(self, question: str) -> tuple[str, TokenUsage]:
+        await self._respond(self._sample_latency())
+        answer = self._text_answer(question)
+        return answer, self._usage(question, answer)
+
+    async def ask_stream(self, question: str) -> AsyncIterator[tuple[str, TokenUsage]]:
+        # a fifth of the latency is spent before the first piece, the rest is spread over the pieces
+        latency = self._sample_latency()
+        await self._respond(latency / 5)
+        answer = self._text_answer(question)
+        pieces = range(0, len(answer), self.stream_piece)
+        for i in pieces:
+            await asyncio.sleep(latency * 4 / 5 / len(pieces))
+            last = i + self.stream_piece >= len(answer)
+            yield answer[i: i + self.stream_piece], self._usage(question, answer) if last else None
+
+    def _translate_json(self, value):
+        if isinstance(value, str):
+            return fake_translate(value)
+        if isinstance(value, list):
+            translated = [self._translate_json(v) for v in value]
+            if translated and all(isinstance(v, str) for v in translated) and self._drop_line():
+                translated.pop(self._random.randrange(len(translated)))
+            return translated
+        if isinstance(value, dict):
+            return {k: self._translate_json(v) for k, v in value.items()}
+        return value
+
+    @staticmethod
+    def _question_json(question: str):
+        """The json payload is the last json value of the question"""
+        decoder = json.JSONDecoder()
+        end = len(question.rstrip())
+        for m in re.finditer(r'^[\[{]', question, re.MULTILINE):
+            try:
+                value, i = decoder.raw_decode(question, m.start())
+            except json.JSONDecodeError:
+                continue
+            if i == end:
+                return value
+        raise ValueError("No json found in question")
+
+    async def structured_output(self, question: str, structure: Structure) -> tuple[Structure, TokenUsage]:
+        await self._respond(self._sample_latency())
+
+        if self._random.random() < self.invalid_json_rate:
+            self.stats.invalid_json += 1
+            raise InvalidJsonException("Gemini response could not be parsed")
+
+        answer = self._translate_json(self._question_json(question))
+        if self._truncated(json.dumps(answer, ensure_ascii=False)):
+            raise InvalidJsonException("Gemini response could not be parsed")
+        return structure.model_validate(answer), self._usage(question, json.dumps(answer, ensure_ascii=False))
+
+    async def compute_question_tokens(self, question: str) -> int:
+        if self.cache_prompt:
+            return self._tokens(question)
+        return self._tokens(self.prompt + '\n' + question)
@@ -1,46 +1,140 @@
+import re
+import time
+import asyncio
+
 from pydantic import BaseModel
-from typing import TypeVar
+from typing import TypeVar, AsyncIterator, Optional
 
 from google import genai
-from google.genai.errors import ClientError, ServerError
-from google.genai.types import GenerateContentResponse
+from google.genai.errors import APIError, ClientError, ServerError
+from google.genai.types import GenerateContentResponse, CachedContent, CreateCachedContentConfig
 
-from src.models import RetriableException, InvalidJsonException
+from src.models import RetriableException, InvalidJsonException, TokenUsage
 import src.logger as logger
 
 
 Structure = TypeVar('Structure', bound=BaseModel)
+retry_delay_regex = re.compile(r'(\d+(?:\.\d+)?)s')
 
 class GeminiClient:
 
     def __init__(self,
-            key: str, model: str, prompt: str, config: dict = None):
+            key: str, model: str, prompt: str, config: dict = None,
+            cache_prompt: bool = False, cache_ttl: int = 3600):
         self.model = model
         self.prompt = prompt
         self.config = config or {}
+        self.cache_prompt = cache_prompt
+        self.cache_ttl = cache_ttl
 
         self.client = genai.Client(api_key=key)
 
-    async def ask(self, question: str) -> str:
+        self._cache: CachedContent = None
+        self._cache_expire = 0.0
+        self._cache_lock = asyncio.Lock()
+
+    @property
+    def cached_prompt_tokens(self) -> int:
+        """Tokens of the prompt served from the context cache, 0 if the prompt is sent inline"""
+        if self._cache is None or self._cache.usage_metadata is None:
+            return 0
+        return self._cache.usage_metadata.total_token_count or 0
+
+    async def _cached_prompt(self) -> Optional[str]:
+        """Name of the cached content holding the prompt, created once and renewed before it expires"""
+        async with self._cache_lock:
+            if self.cache_prompt and time.monotonic() > self._cache_expire:
+                try:
+                    self._cache = await self.client.aio.caches.create(
+                        model=self.model,
+                        config=CreateCachedContentConfig(contents=[self.prompt], ttl=f"{self.cache_ttl}s"))
+                    self._cache_expire = time.monotonic() + self.cache_ttl * 0.9
+                    logger.debug(f"Prompt cached as {self._cache.name}, {self.cached_prompt_tokens} tokens")
+                except (ClientError, ServerError) as ex:
+                    # e.g. prompt below the model minimum cacheable size
+                    logger.warning(f"Could not cache the prompt, sending it with each request - {ex.message}")
+                    self.cache_prompt = False
+                    self._cache = None
+        return self._cache.name if self._cache else None
+
+    async def _with_prompt(self, question: str, config: dict) -> tuple[str, dict]:
+        cached = await self._cached_prompt()
+        if cached:
+            return question, config | {"cached_content": cached}
+        return self.prompt + '\n' + question, config
+
+    async def release_cache(self):
+        if self._cache is None:
+            return
+        try:
+            await self.client.aio.caches.delete(name=self._cache.name)
+        except (ClientError, ServerError) as ex:
+            logger.debug(f"Could not delete cached prompt {self._cache.name} - {ex.message}")
+        self._cache = None
+
+    @staticmethod
+    def _retry_delay(ex: APIError) -> Optional[float]:
+        """Retry delay suggested by the server, from the RetryInfo error details or the Retry-After header"""
+        error = ex.details.get('error', ex.details) if isinstance(ex.details, dict) else {}
+        for detail in error.get('details', None) or []:
+            if isinstance(detail, dict) and detail.get('@type', '').endswith('RetryInfo'):
+                m = retry_delay_regex.fullmatch(str(detail.get('retryDelay', '')))
+                if m: return float(m.group(1))
+
+        headers = getattr(ex.response, 'headers', None) or {}
+        try:
+            return float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _usage(response: GenerateContentResponse) -> TokenUsage:
+        metadata = response.usage_metadata
+        if metadata is None:
+            return None
+        return TokenUsage(
+            prompt_tokens=metadata.prompt_token_count or 0,
+            output_tokens=(metadata.candidates_token_count or 0) + (metadata.thoughts_token_count or 0),
+            cached_tokens=metadata.cached_content_token_count or 0)
+
+    async def ask(self, question: str) -> tuple[str, TokenUsage]:
 
         config= self.config
 
         try:
-            full_question = self.prompt + '\n' + question
+            full_question, config = await self._with_prompt(question, config)
             response = await self.client.aio.models.generate_content(
                 model=self.model, contents=full_question,
                 config=config
             )
         except (ClientError, ServerError) as ex:
             if ex.status in {'RESOURCE_EXHAUSTED', 'UNAVAILABLE'}:
-                raise RetriableException(ex.message)
+                raise RetriableException(ex.message, self._retry_delay(ex))
             else:
                 raise ex
 
-        return response.text
+        return response.text, self._usage(response)
 
+    async def ask_stream(self, question: str) -> AsyncIterator[tuple[str, TokenUsage]]:
+        """Yield the response text as it is generated, together with the usage reported so far"""
+
+        config= self.config
+
+        try:
+            full_question, config = await self._with_prompt(question, config)
+            stream = await self.client.aio.models.generate_content_stream(
+                model=self.model, contents=full_question,
+                config=config
+            )
+            async for response in stream:
+                yield response.text or '', self._usage(response)
+        except (ClientError, ServerError) as ex:
+            if ex.status in {'RESOURCE_EXHAUSTED', 'UNAVAILABLE'}:
+                raise RetriableException(ex.message, self._retry_delay(ex))
+            else:
+                raise ex
 
-    async def structured_output(self, question: str, structure: Structure) -> Structure:
+    async def structured_output(self, question: str, structure: Structure) -> tuple[Structure, TokenUsage]:
 
         config= self.config | {
             "response_mime_type": "application/json",
@@ -48,30 +142,28 @@ class GeminiClient:
         }
 
         try:
-            full_question = self.prompt + '\n' + question
+            full_question, config = await self._with_prompt(question, config)
             response = await self.client.aio.models.generate_content(
                 model=self.model, contents=full_question,
                 config=config
             )
         except (ClientError, ServerError) as ex:
             if ex.status in {'RESOURCE_EXHAUSTED', 'UNAVAILABLE'}:
-                raise RetriableException(ex.message)
+                raise RetriableException(ex.message, self._retry_delay(ex))
             else:
                 raise ex
 
         if response.parsed is None:
             raise InvalidJsonException("Gemini response could not be parsed")
 
-        return response.parsed
+        return response.parsed, self._usage(response)
 
     async def compute_question_tokens(self, question: str) -> int:
-        question = self.prompt + '\n' + question
+        """Count the tokens of the question, prompt included unless it is cached"""
+        if not self._cache:
+            question = self.prompt + '\n' + question
         response = await self.client.aio.models.count_tokens(
             model=self.model,
             contents=question,
         )
         return response.total_tokens
-
-    def estimate_question_tokens(self, question: str) -> int:
-        question = self.prompt + '\n' + question
-        return int(len(question)*0.5)
\ No newline at end of file
@@ -0,0 +1,63 @@
+import os
+import json
+import hashlib
+
+from typing import Optional
+
+import src.logger as logger
+
+
+class TranslationJournal:
+    """Append-only record of the blocks translated for a file, allowing an interrupted
+    translation to resume with only the missing blocks.
+
+    Blocks are identified by the hash of their source lines, each one is written as a json line
+    as soon as its translation completes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._blocks: dict[str, list[str]] = {}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        self._blocks[entry['key']] = entry['translation']
+                    except (json.JSONDecodeError, KeyError):
+                        continue # last line may be truncated if the run was killed while writing
+        self.resumed = len(self._blocks)
+
+        self._fp = None
+
+    @staticmethod
+    def _key(dialogue: list[str]) -> str:
+        return hashlib.sha256('\n'.join(dialogue).encode('utf-8')).hexdigest()
+
+    def get(self, dialogue: list[str]) -> Optional[list[str]]:
+        translation = self._blocks.get(self._key(dialogue))
+        if translation is not None and len(translation) == len(dialogue):
+            return translation
+        return None
+
+    def record(self, dialogue: list[str], translation: list[str]):
+        key = self._key(dialogue)
+        if key in self._blocks:
+            return
+        self._blocks[key] = translation
+        if self._fp is None:
+            self._fp = open(self.path, 'a', encoding='utf-8')
+        self._fp.write(json.dumps({'key': key, 'translation': translation}, ensure_ascii=False) + '\n')
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            logger.debug(f"Removed journal {self.path}")
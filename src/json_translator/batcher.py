@@ -0,0 +1,103 @@
+import asyncio
+
+from dataclasses import dataclass
+from typing import Callable, Awaitable
+
+from src.models import DialogueChunks
+
+
+@dataclass(eq=False)
+class PendingBlock:
+    chunk_id: str
+    chunks: DialogueChunks
+    future: asyncio.Future
+
+
+class ChunkBatcher:
+    """Packs the blocks of chunks submitted by concurrent files into shared requests.
+
+    Blocks are sent as soon as they fill `request_chunks` chunks, or after `linger` seconds
+    with whatever has been collected, and each file receives back only its own chunks.
+    With `cost`, the fraction of a request used by the lines of a chunk, a request is also full
+    when the next block would exceed its token budget.
+    """
+
+    def __init__(
+            self,
+            send: Callable[[str, DialogueChunks], Awaitable[DialogueChunks]],
+            request_chunks: int,
+            linger: float = 1.0,
+            cost: Callable[[list[str]], float] = None):
+        self.send = send
+        self.request_chunks = request_chunks
+        self.linger = linger
+        self.cost = cost
+
+        self._pending: list[PendingBlock] = []
+        self._timer: asyncio.TimerHandle = None
+        self._requests: set[asyncio.Task] = set()
+
+    async def submit(self, chunk_id: str, chunks: DialogueChunks) -> DialogueChunks:
+        block = PendingBlock(chunk_id, chunks, asyncio.get_running_loop().create_future())
+        self._pending.append(block)
+
+        while self._flush(full_only=True):
+            pass
+        if self._pending and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._flush_all)
+
+        return await block.future
+
+    def _flush_all(self):
+        self._timer = None
+        while self._flush():
+            pass
+
+    def _flush(self, full_only: bool = False) -> bool:
+        """Send a first fit batch of the pending blocks, if full_only the batch is sent only when
+        it fills a whole request. Return True if a batch was sent"""
+        self._pending = [b for b in self._pending if not b.future.done()] # drop blocks of files failed meanwhile
+        if not self._pending:
+            return False
+
+        batch: list[PendingBlock] = []
+        size, cost, over_budget = 0, 0.0, False
+        for block in self._pending:
+            block_cost = sum(self.cost(c.dialogue) for c in block.chunks.chunks) if self.cost else 0
+            if batch and cost + block_cost > 1:
+                over_budget = True
+            elif not batch or size + len(block.chunks.chunks) <= self.request_chunks:
+                batch.append(block)
+                size += len(block.chunks.chunks)
+                cost += block_cost
+
+        if full_only and size < self.request_chunks and not over_budget:
+            return False
+
+        self._pending = [b for b in self._pending if b not in batch]
+        if not self._pending and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        request = asyncio.create_task(self._send(batch))
+        self._requests.add(request)
+        request.add_done_callback(self._requests.discard)
+        return True
+
+    async def _send(self, batch: list[PendingBlock]):
+        request_id = batch[0].chunk_id if len(batch) == 1 else f"{batch[0].chunk_id} +{len(batch) - 1} packed"
+        try:
+            result = await self.send(
+                request_id, DialogueChunks(chunks=[c for block in batch for c in block.chunks.chunks]))
+        except Exception as ex:
+            for block in batch:
+                if not block.future.done():
+                    block.future.set_exception(ex)
+            return
+
+        i = 0
+        for block in batch:
+            n = len(block.chunks.chunks)
+            if not block.future.done():
+                block.future.set_result(DialogueChunks(chunks=result.chunks[i: i + n]))
+            i += n
@@ -1,10 +1,17 @@
 from math import ceil
-from itertools import chain
+from itertools import chain, accumulate
 
 from src.models import DialogueChunk, DialogueChunks, MisalignmentException
+from src.token_chunker import TokenChunker
 
 
-def split_chunks(chunks: DialogueChunks, chunks_per_block: int) -> list[DialogueChunks]:
+def split_chunks(
+        chunks: DialogueChunks, chunks_per_block: int, chunker: TokenChunker = None) -> list[DialogueChunks]:
+    if chunker is not None:
+        sizes = chunker.partition([chunker.cost(c.dialogue) for c in chunks.chunks], chunks_per_block)
+        bounds = [0, *accumulate(sizes)]
+        return [DialogueChunks(chunks=chunks.chunks[a:b]) for a, b in zip(bounds, bounds[1:])]
+
     blocks = ceil(len(chunks.chunks)/chunks_per_block)
     q, r = divmod(len(chunks.chunks), blocks)
     return [
@@ -20,18 +27,27 @@ class ChunkedTranslation:
     def __init__(
             self,
             dialogue: list[str],
-            chunk_size: int = 10):
+            chunk_size: int = 10,
+            chunker: TokenChunker = None):
         self.chunk_size = chunk_size
         self._translated = False
 
-        self.chunks: DialogueChunks = DialogueChunks(chunks=[
-            DialogueChunk(
-                from_line= i,
-                to_line= i + chunk_size,
-                dialogue= dialogue[i: i + chunk_size],
-            )
-            for i in range(0, len(dialogue), chunk_size)
-        ])
+        if chunker is not None:
+            splitted = chunker.split(dialogue, chunk_size)
+            starts = [0, *accumulate(len(lines) for lines in splitted)]
+            self.chunks: DialogueChunks = DialogueChunks(chunks=[
+                DialogueChunk(from_line= i, to_line= i + len(lines), dialogue= lines)
+                for i, lines in zip(starts, splitted)
+            ])
+        else:
+            self.chunks: DialogueChunks = DialogueChunks(chunks=[
+                DialogueChunk(
+                    from_line= i,
+                    to_line= min(i + chunk_size, len(dialogue)),
+                    dialogue= dialogue[i: i + chunk_size],
+                )
+                for i in range(0, len(dialogue), chunk_size)
+            ])
         self.misaligned_chunks: list[int] = []
 
     def add_translation(self, chunks: DialogueChunks):
@@ -48,25 +64,6 @@ class ChunkedTranslation:
             original._translated = translated.dialogue
         self._translated = True
 
-    def get_misaligned_chunks(self) -> DialogueChunks:
-        return DialogueChunks(chunks=[self.chunks.chunks[i] for i in self.misaligned_chunks])
-
-    def apply_corrections(self, chunks: DialogueChunks):
-        if len(chunks.chunks) != len(self.misaligned_chunks):
-            return
-        temp_misaligned = []
-        for i, index in enumerate(self.misaligned_chunks):
-            original, translated = self.chunks.chunks[index], chunks.chunks[i]
-            if len(original.dialogue) != len(translated.dialogue):
-                temp_misaligned.append(index)
-                diff = len(original.dialogue) - len(translated.dialogue)
-                if diff > 0:
-                    translated.dialogue.extend(original.dialogue[-diff:])
-                else:
-                    translated.dialogue = translated.dialogue[:-diff]
-            original._translated = translated.dialogue
-        self.misaligned_chunks = temp_misaligned
-
     def get_translated_dialogue(self) -> list[str]:
         if not self._translated: raise Exception("No translation available")
         return [l for chunk in self.chunks.chunks for l in chunk._translated]
\ No newline at end of file
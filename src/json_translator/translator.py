@@ -1,15 +1,25 @@
+import json
 import asyncio
 import traceback
+
+from functools import partial
 from string import Template
 
 from src.models import *
-from src.rate_limiter import RateLimitedLLM
+from src.rate_limiter import RateLimitedLLM, request_latency
+from src.translation_memory import TranslationMemory
+from src.token_chunker import TokenChunker
+from src.chunk_controller import ChunkSizeController
+from src.speaker_table import SpeakerTable
 from src.json_translator.chunker import ChunkedTranslation, split_chunks, flatten_chunks
+from src.json_translator.batcher import ChunkBatcher
 import src.logger as logger
+import src.telemetry as telemetry
 
 from importlib import resources
 
 prompt = Template(resources.files(__package__).joinpath("prompt.md").read_text())
+compact_prompt = Template(resources.files(__package__).joinpath("prompt_compact.md").read_text())
 
 class JsonChunkerTranslator:
 
@@ -17,34 +27,59 @@ class JsonChunkerTranslator:
             self,
             llm: RateLimitedLLM,
             chunk_lines: int,
-            request_chunks: int):
+            request_chunks: int,
+            memory: TranslationMemory = None,
+            pack_linger: float = None,
+            chunker: TokenChunker = None,
+            controller: ChunkSizeController = None,
+            wire_format: str = "chunks",
+            speaker_table: bool = False):
+        if wire_format not in ("chunks", "compact"): raise ValueError(f"Unknown json format {wire_format}")
         self.llm = llm
         self.chunk_lines = chunk_lines
         self.request_chunks = request_chunks
-        self._reduced_request_chunks = request_chunks/2
+        self.memory = memory
+        self.chunker = chunker # requests sized by tokens, at most chunk_lines and request_chunks
+        self.controller = controller # chunks per request tuned at runtime, at most request_chunks
+        self.wire_format = wire_format # compact sends and receives bare arrays of lines
+        self.speaker_table = speaker_table # speaker names abbreviated in each request
+
+        # blocks of different files are packed together in the same request
+        self.batcher = ChunkBatcher(
+            self._send_block, request_chunks, pack_linger,
+            cost=chunker.cost if chunker else None) if pack_linger is not None else None
 
-    async def __call__(self, filename: str, dialogue: list[str]) -> TranslationOutput:
-        translation = ChunkedTranslation(dialogue, self.chunk_lines)
+    async def __call__(
+            self, filename: str, dialogue: list[str], journal: TranslationJournal = None) -> TranslationOutput:
+        translation = ChunkedTranslation(dialogue, self.chunk_lines, self.chunker)
 
         result = await self._split_and_translate(
-            filename, translation.chunks, self.request_chunks)
+            filename, translation.chunks, self._request_chunks(),
+            partial(self._translate_block, journal=journal))
 
+        # misaligned chunks are corrected per block, the ones still misaligned are reported
         translation.add_translation(result)
-        misalignments = await self._handle_misalignments(filename, translation)
+        misaligned = [translation.chunks.chunks[i] for i in translation.misaligned_chunks]
+        misalignments = [(c.from_line, c.to_line) for c in misaligned]
 
         translated =  translation.get_translated_dialogue()
 
         return TranslationOutput(filename, translated, misalignments)
 
+    def _request_chunks(self) -> int:
+        return self.controller.size if self.controller else self.request_chunks
+
     async def _split_and_translate(
-            self, chunk_id: str, chunks: DialogueChunks, request_chunks: int) -> DialogueChunks:
+            self, chunk_id: str, chunks: DialogueChunks, request_chunks: int,
+            translate_block: Callable[[str, DialogueChunks], Awaitable[DialogueChunks]] = None) -> DialogueChunks:
 
-        splitted = split_chunks(chunks, request_chunks)
+        translate_block = translate_block or self._translate_block
+        splitted = split_chunks(chunks, request_chunks, self.chunker)
         chunk_id = f"{chunk_id}.{{}}" if len(splitted) > 1 else chunk_id
         try:
             async with asyncio.TaskGroup() as tg:
                 tasks = [
-                    tg.create_task(self._translate_block(chunk_id.format(i+1), chunk))
+                    tg.create_task(translate_block(chunk_id.format(i+1), chunk))
                     for i, chunk in enumerate(splitted)]
 
         except* Exception as exs:
@@ -53,35 +88,107 @@ class JsonChunkerTranslator:
         return flatten_chunks([t.result() for t in tasks])
 
     async def _translate_block(
-            self, chunk_id: str, chunks: DialogueChunks) -> DialogueChunks:
+            self, chunk_id: str, chunks: DialogueChunks, journal: TranslationJournal = None) -> DialogueChunks:
+        # chunks are served from journal or memory only when all their lines are available, to keep their context intact
+        result: list[list[str]] = [journal.get(c.dialogue) if journal else None for c in chunks.chunks]
+        if resumed := sum(1 for lines in result if lines is not None):
+            logger.info(f"{chunk_id}: {resumed} chunks resumed from journal")
+
+        if self.memory is not None:
+            served = 0
+            for i, chunk in enumerate(chunks.chunks):
+                if result[i] is None and None not in (lines := await self.memory.lookup(chunk.dialogue)):
+                    result[i] = lines
+                    served += 1
+            if served:
+                logger.info(f"{chunk_id}: {served} chunks served from translation memory")
+
+        missing = [i for i, lines in enumerate(result) if lines is None]
+        if missing:
+            translated = await self._request_block(
+                chunk_id, DialogueChunks(chunks=[chunks.chunks[i] for i in missing]))
+            for i, chunk in zip(missing, translated.chunks):
+                result[i] = chunk.dialogue
+
+            misaligned = [i for i in missing if len(result[i]) != len(chunks.chunks[i].dialogue)]
+            if misaligned:
+                telemetry.record_misalignment(chunk_id, sum(len(chunks.chunks[i].dialogue) for i in misaligned))
+                # corrected right away, while the other blocks are still translating
+                corrected = await self._correct_block(chunk_id, chunks, misaligned)
+                for i, chunk in zip(misaligned, corrected.chunks if corrected else []):
+                    if len(chunk.dialogue) == len(chunks.chunks[i].dialogue):
+                        result[i] = chunk.dialogue
+
+            for i in missing:
+                original = chunks.chunks[i].dialogue
+                if len(result[i]) == len(original): # misaligned chunks are not stored
+                    if self.memory is not None:
+                        await self.memory.store(zip(original, result[i]))
+                    if journal is not None:
+                        journal.record(original, result[i])
+
+        telemetry.record_progress(sum(len(c.dialogue) for c in chunks.chunks))
+        return DialogueChunks(chunks=[
+            DialogueChunk(from_line=c.from_line, to_line=c.to_line, dialogue=lines)
+            for c, lines in zip(chunks.chunks, result)])
+
+    async def _correct_block(
+            self, chunk_id: str, chunks: DialogueChunks, misaligned: list[int]) -> Optional[DialogueChunks]:
+        """Request again the misaligned chunks of a block, None if the request fails"""
+        logger.warning(f"{chunk_id}: {len(misaligned)} chunks misaligned, trying correction")
         try:
-            json_str = chunks.model_dump_json(indent=2)
-            text = prompt.substitute(lines_per_chunk= self.chunk_lines, json= json_str)
+            return await self._request_block(
+                f"{chunk_id} corrections", DialogueChunks(chunks=[chunks.chunks[i] for i in misaligned]))
+        except (InvalidJsonException, RetriableException) as ex:
+            logger.warning(f"{chunk_id}: correction failed - {ex}")
+            return None
+
+    async def _request_block(
+            self, chunk_id: str, chunks: DialogueChunks) -> DialogueChunks:
+        if self.batcher is not None:
+            self.batcher.request_chunks = self._request_chunks()
+            return await self.batcher.submit(chunk_id, chunks)
+        return await self._send_block(chunk_id, chunks)
+
+    async def _ask_chunks(self, chunk_id: str, chunks: DialogueChunks) -> DialogueChunks:
+        speakers = SpeakerTable(l for c in chunks.chunks for l in c.dialogue) if self.speaker_table else SpeakerTable()
+        encoded = [[speakers.encode(l) for l in c.dialogue] for c in chunks.chunks]
+
+        if self.wire_format == "chunks":
+            json_str = DialogueChunks(chunks=[
+                DialogueChunk(from_line=c.from_line, to_line=c.to_line, dialogue=lines)
+                for c, lines in zip(chunks.chunks, encoded)]).model_dump_json(indent=2)
+            text = prompt.substitute(lines_per_chunk= self.chunk_lines, json= speakers.header() + json_str)
             resp: DialogueChunks = await self.llm.structured_output(chunk_id, text, DialogueChunks)
+            translated = [c.dialogue for c in resp.chunks]
+        else:
+            json_str = json.dumps(encoded, ensure_ascii=False)
+            text = compact_prompt.substitute(json= speakers.header() + json_str)
+            resp: CompactDialogueChunks = await self.llm.structured_output(chunk_id, text, CompactDialogueChunks)
+            translated = resp.root
+
+        if len(translated) != len(chunks.chunks): raise InvalidJsonException("Number of translated chunks does not match")
+        return DialogueChunks(chunks=[
+            DialogueChunk(from_line=c.from_line, to_line=c.to_line, dialogue=[speakers.decode(l) for l in lines])
+            for c, lines in zip(chunks.chunks, translated)])
+
+    async def _send_block(
+            self, chunk_id: str, chunks: DialogueChunks) -> DialogueChunks:
+        try:
+            resp = await self._ask_chunks(chunk_id, chunks)
             if len(resp.chunks) != len(chunks.chunks): raise InvalidJsonException("Number of translated chunks does not match")
+            if self.controller:
+                aligned = all(len(a.dialogue) == len(b.dialogue) for a, b in zip(chunks.chunks, resp.chunks))
+                self.controller.record(len(chunks.chunks), aligned, request_latency.get())
             return resp
         except InvalidJsonException:
-            if len(chunks.chunks) > self._reduced_request_chunks:
+            if self.controller:
+                self.controller.record(len(chunks.chunks), False)
+            reduced_chunks = max(self._request_chunks()/2, 1)
+            if len(chunks.chunks) > reduced_chunks:
                 logger.warning(f"{chunk_id}: Gemini returned an invalid json, retrying with reduced context window")
-                return await self._split_and_translate(chunk_id, chunks, self._reduced_request_chunks)
+                telemetry.record_halving(chunk_id, len(chunks.chunks))
+                return await self._split_and_translate(
+                    chunk_id, chunks, reduced_chunks, self._send_block)
             else:
                 raise
-
-    async def _handle_misalignments(
-            self, filename: str, subs: ChunkedTranslation) -> list[tuple[int, int]]:
-        misaligned = subs.get_misaligned_chunks()
-        if misaligned.chunks:
-            if len(misaligned.chunks) > self.request_chunks:
-                raise MisalignmentException(f"{filename}: result translation did no match original structure")
-
-            logger.warning(
-                f"{filename}: result translation has some line misalignment, trying correction")
-
-            json_str = misaligned.model_dump_json(indent=2)
-            text = prompt.substitute(lines_per_chunk= self.chunk_lines, json= json_str)
-            result = await self.llm.structured_output(
-                f"{filename} corrections", text, DialogueChunks)
-            subs.apply_corrections(result)
-
-        misalignments = [self.chunk_lines*i for i in subs.misaligned_chunks]
-        return [(l, l + self.chunk_lines) for l in misalignments]
\ No newline at end of file
@@ -0,0 +1,16 @@
+import os
+import json
+
+def load_keyed(path: str) -> dict[str, dict]:
+    """Values saved by key in the json file at path, empty if it does not exist"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as fp:
+        return json.load(fp)
+
+def save_keyed(path: str, key: str, value: dict):
+    """Save value under key, keeping the other keys saved meanwhile by other runs or objects"""
+    saved = load_keyed(path)
+    saved[key] = value
+    with open(path, 'w+', encoding='utf-8') as fp:
+        json.dump(saved, fp, indent=2)
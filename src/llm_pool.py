@@ -0,0 +1,94 @@
+import time
+
+from typing import Callable, Awaitable, Any, AsyncIterator
+
+from src.gemini import Structure
+from src.rate_limiter import RateLimitedLLM, LimiterStats
+from src.models import RetriableException
+import src.logger as logger
+
+
+class LLMPool:
+    """Spreads requests over several rate limited backends, each with its own key, model and budget.
+
+    Every request goes to the backend with the most free budget. When a backend answers with a
+    retriable error it backs off, and the request fails over to the next best one instead of
+    retrying against the same exhausted quota. Backends should be created with max_retries=0,
+    retries are handled by the pool.
+    """
+
+    def __init__(
+            self,
+            backends: list[RateLimitedLLM],
+            max_retries: int):
+        if not backends: raise ValueError("LLMPool requires at least one backend")
+        self.backends = backends
+        self.max_retries = max_retries
+
+    @property
+    def model(self) -> str:
+        return '+'.join(b.model for b in self.backends)
+
+    @property
+    def prompt(self) -> str:
+        return self.backends[0].prompt
+
+    @property
+    def stats(self) -> LimiterStats:
+        total = LimiterStats()
+        for b in self.backends:
+            for field, value in vars(b.stats).items():
+                setattr(total, field, getattr(total, field) + value)
+        return total
+
+    async def close(self):
+        for b in self.backends:
+            await b.close()
+
+    def _choose(self) -> RateLimitedLLM:
+        """Backend with the most free budget among the ones not backing off,
+        or the one whose backoff ends first if all of them are"""
+        now = time.monotonic()
+        available = [b for b in self.backends if b.paused_until <= now]
+        if not available:
+            return min(self.backends, key=lambda b: b.paused_until)
+        return max(available, key=lambda b: b.free_budget())
+
+    def _attempts(self) -> int:
+        # every backend gets a chance before the retries are counted
+        return self.max_retries + len(self.backends)
+
+    async def _request(
+            self, request_id: str, call: Callable[[RateLimitedLLM], Awaitable[Any]]) -> Any:
+        for attempt in range(self._attempts()):
+            backend = self._choose()
+            try:
+                return await call(backend)
+            except RetriableException:
+                if attempt == self._attempts() - 1:
+                    raise
+                logger.warning(f"{request_id}: {backend.model} exhausted, failing over")
+
+    async def ask(self, request_id: str, text: str) -> str:
+        return await self._request(request_id, lambda b: b.ask(request_id, text))
+
+    async def structured_output(
+            self, request_id: str, text: str, structure: Structure) -> Structure:
+        return await self._request(request_id, lambda b: b.structured_output(request_id, text, structure))
+
+    async def ask_stream(self, request_id: str, text: str) -> AsyncIterator[str]:
+        for attempt in range(self._attempts()):
+            backend = self._choose()
+            started = False
+            stream = backend.ask_stream(request_id, text)
+            try:
+                async for piece in stream:
+                    started = True
+                    yield piece
+                return
+            except RetriableException:
+                if started or attempt == self._attempts() - 1:
+                    raise
+                logger.warning(f"{request_id}: {backend.model} exhausted, failing over")
+            finally:
+                await stream.aclose()
@@ -1,11 +1,20 @@
+import sys
+import time
+import atexit
+import queue
+import logging
+import logging.handlers
+import threading
+
+from collections import deque, Counter
 from dataclasses import dataclass
 from enum import Enum
-from typing import List
 from datetime import datetime
 
 from rich.console import Console, Text
 
 class LogLevel(Enum):
+    VERBOSE = "verbose"
     DEBUG = "debug"
     INFO = "info"
     SUCCESS = "success"
@@ -18,6 +27,7 @@ class Log:
     level: LogLevel
 
 LEVEL_STYLES = {
+    LogLevel.VERBOSE: "grey50",
     LogLevel.DEBUG: "grey50",
     LogLevel.INFO: "white",
     LogLevel.SUCCESS: "green",
@@ -25,30 +35,143 @@ LEVEL_STYLES = {
     LogLevel.ERROR: "red",
 }
 
+FILE_LEVELS = {
+    LogLevel.VERBOSE: logging.DEBUG,
+    LogLevel.DEBUG: logging.DEBUG,
+    LogLevel.INFO: logging.INFO,
+    LogLevel.SUCCESS: logging.INFO,
+    LogLevel.WARNING: logging.WARNING,
+    LogLevel.ERROR: logging.ERROR,
+}
+
 console = Console()
-saved_logs: List[Log] = []
+saved_logs: deque[Log] = deque(maxlen=500) # last entries of the final log
+saved_counts: Counter[LogLevel] = Counter()
 failed = 0
 debug_enabled = False
+flush_interval = 0.1 # seconds the renderer waits for more lines to render them together
+flush_timeout = 5.0 # seconds flush waits for the renderer
+
+_lines: queue.SimpleQueue = queue.SimpleQueue() # (level, timestamp, message) to render, or flush events
+_renderer: threading.Thread = None
+_file_logger: logging.Logger = None
+_file_listener: logging.handlers.QueueListener = None
+
+def setup(log_path: str = None, max_bytes: int = 10_000_000, backups: int = 3, max_saved_logs: int = 500):
+    """Keep the last max_saved_logs entries for the final log and write every line, per request ones
+    included, to a log file rotated at max_bytes. The file is written by a background thread."""
+    global saved_logs, _file_logger, _file_listener
+    saved_logs = deque(saved_logs, maxlen=max_saved_logs)
+    if log_path:
+        handler = logging.handlers.RotatingFileHandler(
+            log_path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        records = queue.SimpleQueue()
+        _file_listener = logging.handlers.QueueListener(records, handler)
+        _file_listener.start()
+        _file_logger = logging.getLogger('translate_subs')
+        _file_logger.setLevel(logging.DEBUG)
+        _file_logger.propagate = False
+        _file_logger.addHandler(logging.handlers.QueueHandler(records))
+
+def close():
+    global _file_logger, _file_listener
+    flush()
+    if _file_listener is not None:
+        _file_listener.stop()
+        for handler in _file_listener.handlers:
+            handler.close()
+        _file_logger.handlers.clear()
+        _file_logger, _file_listener = None, None
+
+def _render_plain(lines: list[tuple[LogLevel, str, str]], ex: Exception):
+    """Lines the console failed to render, e.g. not encodable on a legacy Windows console"""
+    try:
+        console.begin_capture() # drops the segments the console failed to write, or the next lines fail too
+        console.end_capture()
+        encoding = sys.stdout.encoding or 'utf-8'
+        text = '\n'.join(timestamp + message for _, timestamp, message in lines)
+        sys.stdout.write(text.encode(encoding, 'replace').decode(encoding) + '\n')
+        sys.stderr.write(f"Log lines rendered as plain text: {ex!r}\n")
+    except Exception:
+        pass
+
+def _render_batches():
+    while True:
+        item = _lines.get()
+        lines, flushes = [], []
+        deadline = time.monotonic() + flush_interval
+        while True:
+            if isinstance(item, threading.Event):
+                flushes.append(item)
+                break # rendered right away
+            lines.append(item)
+            try:
+                item = _lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+        if lines:
+            try:
+                console.print(Text('\n').join(
+                    Text(timestamp, style="grey50") + Text(message, style=LEVEL_STYLES.get(level, "grey50"))
+                    for level, timestamp, message in lines))
+            except Exception as ex: # the renderer must outlive a failing line, or every later one is lost
+                _render_plain(lines, ex)
+        for event in flushes:
+            event.set()
+
+def _render(level: LogLevel, message: str, timestamped: bool):
+    """Queue a line for the renderer thread, so that callers on the event loop do not wait for the console"""
+    global _renderer
+    if _renderer is None:
+        _renderer = threading.Thread(target=_render_batches, name='log_renderer', daemon=True)
+        _renderer.start()
+        atexit.register(flush) # the lines queued before an exit are not lost with the daemon thread
+    _lines.put((level, datetime.now().strftime("[%H:%M:%S] - ") if timestamped else '', message))
+
+def flush(timeout: float = None):
+    """Wait for the queued lines to be rendered, at most timeout seconds (flush_timeout if None)"""
+    if _renderer is None or not _renderer.is_alive():
+        return
+    rendered = threading.Event()
+    _lines.put(rendered)
+    rendered.wait(flush_timeout if timeout is None else timeout)
 
 def log(level: LogLevel, message: str, timestamped: bool = True, save: bool = False):
     global failed
-    timestamp = datetime.now().strftime("[%H:%M:%S] - ") if timestamped else ''
-    style = LEVEL_STYLES.get(level, "grey50")
-    console.print(Text(timestamp, style="grey50") + Text(message, style=style))
+    if _file_logger is not None:
+        _file_logger.log(FILE_LEVELS[level], message)
+    _render(level, message, timestamped)
     if save:
         saved_logs.append(Log(message, level))
+        saved_counts[level] += 1
         if level == LogLevel.ERROR:
            failed += 1
 
 def print_final_log():
+    flush()
     if failed:
         log(LogLevel.ERROR, f"failed: {failed}\n", timestamped=False)
-    for entry in saved_logs:
-        log(entry.level, entry.message, timestamped=False)
+    omitted = sum(saved_counts.values()) - len(saved_logs)
+    if omitted:
+        counts = ', '.join(f"{n} {level.value}" for level, n in saved_counts.items())
+        log(LogLevel.INFO, f"{counts} - only the last {len(saved_logs)} shown", timestamped=False)
+    for entry in saved_logs: # already in the log file
+        _render(entry.level, entry.message, timestamped=False)
+    flush()
+
+def verbose(msg: str):
+    """Per request lines, written to the log file and shown only with debug enabled"""
+    if debug_enabled:
+        log(LogLevel.VERBOSE, msg)
+    elif _file_logger is not None:
+        _file_logger.debug(msg)
 
 def debug(msg: str, timestamped: bool = True, save: bool = False):
     if debug_enabled:
         log(LogLevel.DEBUG, msg, timestamped, save)
+    elif _file_logger is not None:
+        _file_logger.debug(msg)
 
 def info(msg: str, timestamped: bool = True, save: bool = False):
     log(LogLevel.INFO, msg, timestamped, save)
@@ -60,4 +183,4 @@ def warning(msg: str, timestamped: bool = True, save: bool = False):
     log(LogLevel.WARNING, msg, timestamped, save)
 
 def error(msg: str, timestamped: bool = True, save: bool = False):
-    log(LogLevel.ERROR, msg, timestamped, save)
\ No newline at end of file
+    log(LogLevel.ERROR, msg, timestamped, save)
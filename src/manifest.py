@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+
+from dataclasses import dataclass, field
+from typing import Optional
+
+import src.logger as logger
+
+manifest_extension = '.manifest'
+untranslated_line = '-' # hash of a line left misaligned, translated again on the next run
+
+def manifest_path(out_path: str) -> str:
+    return out_path + manifest_extension
+
+def file_digest(file_path: str) -> str:
+    with open(file_path, 'rb') as fp:
+        return hashlib.file_digest(fp, 'sha256').hexdigest()
+
+def line_hashes(texts: list[str]) -> list[str]:
+    return [hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest() for text in texts]
+
+@dataclass
+class TranslationManifest:
+    """Hashes of a source file and of the text of its dialogue lines, saved next to the translated file.
+
+    The first line of the manifest holds the size, modification time and hash of the source, so that
+    unchanged sources are recognized without reading the rest of the manifest or parsing them, the
+    following lines the hashes of the dialogue lines in the order of the translated file. Lines left
+    misaligned are saved as untranslated, and counted in the header so that their file is found again.
+    """
+    size: int
+    mtime_ns: int
+    digest: str
+    lines: list[str] = field(default_factory=list)
+    untranslated: int = 0
+
+    @classmethod
+    def of_file(cls, file_path: str) -> 'TranslationManifest':
+        stat = os.stat(file_path)
+        return cls(stat.st_size, stat.st_mtime_ns, file_digest(file_path))
+
+    @classmethod
+    def load(cls, path: str, header_only: bool = False) -> Optional['TranslationManifest']:
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                header = json.loads(fp.readline())
+                manifest = cls(
+                    header['size'], header['mtime_ns'], header['digest'], untranslated=header.get('untranslated', 0))
+                if not header_only:
+                    manifest.lines = fp.read().split()
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError, KeyError) as ex:
+            logger.debug(f"Ignored manifest {path}: {ex}")
+            return None
+        return manifest
+
+    def mark_untranslated(self, ranges: list[tuple[int, int]]):
+        """Save the lines in ranges, end excluded, as untranslated"""
+        for a, b in ranges:
+            self.lines[a:b] = [untranslated_line] * (b - a)
+        self.untranslated = self.lines.count(untranslated_line)
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps({
+                'size': self.size, 'mtime_ns': self.mtime_ns, 'digest': self.digest,
+                'untranslated': self.untranslated}) + '\n')
+            fp.write('\n'.join(self.lines))
+
+    def matches(self, file_path: str) -> bool:
+        """Whether file_path is the source the manifest was saved for, hashing it only if it was touched"""
+        stat = os.stat(file_path)
+        if stat.st_size != self.size:
+            return False
+        return stat.st_mtime_ns == self.mtime_ns or file_digest(file_path) == self.digest
+
+def source_changed(file_path: str, out_path: str) -> bool:
+    """Whether the source of an existing translation changed since the manifest saved next to it, or
+    lines of it were left untranslated, False if there is no manifest"""
+    manifest = TranslationManifest.load(manifest_path(out_path), header_only=True)
+    return manifest is not None and (manifest.untranslated > 0 or not manifest.matches(file_path))
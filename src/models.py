@@ -1,32 +1,97 @@
-from typing import Optional, Any, Protocol, Callable, Awaitable
+from typing import Optional, Any, Protocol, Callable, Awaitable, TextIO
 from dataclasses import dataclass
 
-from pydantic import BaseModel
+from pydantic import BaseModel, RootModel
+
+from src.journal import TranslationJournal
 
 class AssIgnore(BaseModel):
     field: str
     values: set[str]
-    _field_i: int
 
 class AssSettings(BaseModel):
     ignore: Optional[list[AssIgnore]] = None
+    lean: bool = False # short per line tag markers, no speaker prefix for unnamed lines
+
+class MemorySettings(BaseModel):
+    path: str = "translation_memory.sqlite"
+    max_entries: Optional[int] = None
+    max_age_days: Optional[float] = None
+
+class BackendSettings(BaseModel):
+    model: str
+    key_env: Optional[str] = None # env variable holding the gemini key
+    key_file: Optional[str] = None # file holding the gemini key
+    requests_per_minutes: int = 15
+    token_per_minutes: int = 1000000
+    max_concurrent_requests: Optional[int] = None
+
+class ModelLimits(BaseModel):
+    input_tokens: int = 1048576
+    output_tokens: int = 8192
 
 class Config(BaseModel):
     original_language: str
     translate_to: str
     outfile_suffix: str
+    recursive: bool = False # also translate the files in the subfolders of the given folders
     model: str = "gemini-2.0-flash-lite"
     translator_type: str = "text"
+    json_format: str = "chunks" # or "compact"
+    speaker_table: bool = False
     lines_per_chunk: int = 500
+    token_chunking: bool = False
+    chunk_token_fill: float = 0.8
+    model_limits: dict[str, ModelLimits] = {}
+    adaptive_chunking: bool = False
+    chunk_latency_target: Optional[float] = None
+    chunk_controller_path: Optional[str] = None
+    streaming: bool = False
     chunks_per_request: int = 10
+    pack_requests: bool = False
+    pack_linger_seconds: float = 1.0
     requests_per_minutes: int = 15
     token_per_minutes: int = 1000000
     max_concurrent_requests: Optional[int] = None
+    schedule_policy: str = "fifo" # or "shortest", "deadline"
+    deadline_seconds_per_line: float = 0.1
+    max_open_files: Optional[int] = None
     content_config: dict[str, Any] = {}
+    cache_prompt: bool = False
+    cache_ttl_seconds: int = 3600
+    cached_token_weight: float = 1.0
+    backends: list[BackendSettings] = []
+    backoff_base_seconds: float = 2
+    backoff_max_seconds: float = 120
     max_retries: int = 2
+    resume_journal: bool = False
+    manifest: bool = False # retranslate only the changed lines of updated files
+    dedup_lines: bool = False
+    io_workers: int = 1 # 0 reads, parses and writes files on the event loop
+    io_processes: bool = False
+    token_calibration_path: Optional[str] = None
+    seed_token_estimates: bool = False
     ass_settings: AssSettings
+    translation_memory: Optional[MemorySettings] = None
+    telemetry_path: Optional[str] = None # jsonl of the requests and files, appended as they complete
+    metrics_path: Optional[str] = None # prometheus textfile written at the end of the run
+    dashboard: bool = True # live view of the open files, rate limits and ETA when the output is a terminal
+    log_path: Optional[str] = None # rotating file with every log line, the per request ones included
+    log_max_bytes: int = 10000000
+    log_backups: int = 3
+    max_saved_logs: int = 500 # entries shown in the final log
     debug: bool = False
 
+@dataclass
+class TokenUsage:
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
 @dataclass
 class TranslationOutput:
     name: str
@@ -37,7 +102,9 @@ class MisalignmentException(Exception):
     pass
 
 class RetriableException(Exception):
-    pass
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after # seconds suggested by the server before retrying
 
 class InvalidJsonException(Exception):
     pass
@@ -51,12 +118,22 @@ class TranslationFile(Protocol):
         """Map simple dialogue line numbers to the corresponding lines in the final file"""
         ...
 
+    def get_texts(self) -> list[str]:
+        """Return the text of the dialogue lines as it is in the file, format tags included"""
+        ...
+
     def get_translation(self, translation: TranslationOutput) -> str:
         """Recompose the final file structure with the translated dialogue"""
         ...
 
+    def write_translation(self, translation: TranslationOutput, fp: TextIO, texts: list[Optional[str]] = None):
+        """Write the final file structure with the translated dialogue to fp, the lines with a text
+        in `texts` are written with that text as is instead"""
+        ...
+
 class Translator(Protocol):
-    async def __call__(self, filename: str, dialogue: list[str]) -> TranslationOutput: ...
+    async def __call__(
+        self, filename: str, dialogue: list[str], journal: TranslationJournal = None) -> TranslationOutput: ...
 
 class DialogueChunk(BaseModel):
     from_line: int
@@ -65,4 +142,8 @@ class DialogueChunk(BaseModel):
     _translated: list[str] = None
 
 class DialogueChunks(BaseModel):
-    chunks: list[DialogueChunk]
\ No newline at end of file
+    chunks: list[DialogueChunk]
+
+class CompactDialogueChunks(RootModel[list[list[str]]]):
+    """Chunks as bare arrays of lines, without keys and line numbers"""
+    pass
\ No newline at end of file
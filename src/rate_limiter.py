@@ -1,19 +1,51 @@
 import asyncio
+import heapq
+import random
+import time
 
-from datetime import datetime, timezone, timedelta
+from datetime import timedelta
 from collections import deque
-from dataclasses import dataclass
+from itertools import count
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from math import inf
+from typing import Callable, Awaitable, Any, AsyncIterator
 
 from src.gemini import GeminiClient, Structure
+from src.token_estimator import TokenEstimator
 from src.models import *
 import src.logger as logger
+import src.telemetry as telemetry
+
+# api latency of the last request completed by the current task, queue wait and backoffs excluded
+request_latency: ContextVar[float] = ContextVar('request_latency', default=None)
+# queue priority of the requests of the current task, lower first, set by the RequestScheduler
+request_priority: ContextVar[tuple] = ContextVar('request_priority', default=())
 
 @dataclass
 class LogEntry:
-    utc: datetime
+    time: float # monotonic completion time
     tokens: int
 
+@dataclass
+class LimiterStats:
+    requests: int = 0
+    retries: int = 0
+    reserved_tokens: int = 0
+    used_tokens: int = 0
+    cached_tokens: int = 0
+    queue_wait: float = 0 # seconds spent in queue, summed over requests
+    backoffs: int = 0
+    backoff_time: float = 0 # seconds admissions were paused by backoffs
+    idle: float = 0 # seconds with requests in queue and none running
+
+@dataclass(order=True)
+class Waiter:
+    priority: tuple
+    arrival: int # keeps the order of requests with the same priority
+    tokens: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
 class RateLimitedLLM:
 
     def __init__(self,
@@ -22,108 +54,303 @@ class RateLimitedLLM:
             tokens_per_minute: int,
             max_retries: int,
             max_concurrent_requests: int = None,
-            wait_window: timedelta = timedelta(seconds=60)):
+            wait_window: timedelta = timedelta(seconds=60),
+            estimator: TokenEstimator = None,
+            seed_estimates: bool = False,
+            backoff_base: float = 2,
+            backoff_max: float = 120):
 
         self.client = client
+        self.estimator = estimator or TokenEstimator(client)
+        self.seed_estimates = seed_estimates
         self.rpm = requests_per_minute
         self.tpm = tokens_per_minute
         self.max_retries = max_retries
         self.max_concurrent_requests = max_concurrent_requests or inf
         self.wait_window = wait_window
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
 
+        self._window = wait_window.total_seconds()
         self._retries = 0
         self._minute_tokens = 0
         self._minute_requests = 0
         self._running = 0
         self._completed_log: deque[LogEntry] = deque()
+        self._waiters: list[Waiter] = [] # heap of the requests waiting for budget, by priority then arrival
+        self._arrivals = count()
+        self._wakeup: asyncio.TimerHandle = None
         self._waiting_warning = False
+        self._idle_since: float = None
+        self._failures = 0 # consecutive backoffs, each escalating the delay of the next one
+        self._paused_until = 0.0 # monotonic time until which admissions are paused by a backoff
+        self.stats = LimiterStats()
 
     def _clean_window(self):
-        while (
-                self._completed_log
-                and datetime.now(tz=timezone.utc) - self._completed_log[0].utc > self.wait_window):
+        now = time.monotonic()
+        while self._completed_log and now - self._completed_log[0].time > self._window:
             self._minute_tokens -= self._completed_log.popleft().tokens
             self._minute_requests -= 1
 
-    def _try_start(self, tokens_n: int) -> bool:
-
-        self._clean_window()
-
-        if (
+    def _can_start(self, tokens_n: int) -> bool:
+        return (
             self._minute_requests < self.rpm
             and self._running < self.max_concurrent_requests
             and self._minute_tokens + tokens_n <= self.tpm
-        ):
-            self._minute_requests += 1
-            self._minute_tokens += tokens_n
-            self._running += 1
-            self._waiting_warning = False
-            return True
-
-        elif self._running == 0 and not self._waiting_warning:
-            wait = self.wait_window + self._completed_log[0].utc - datetime.now(tz=timezone.utc)
-            logger.warning(f"Waiting {max(wait.seconds, 1)} seconds for rate limits")
+            and time.monotonic() >= self._paused_until)
+
+    def _start(self, tokens_n: int):
+        self._minute_requests += 1
+        self._minute_tokens += tokens_n
+        self._running += 1
+        self._waiting_warning = False
+        self.stats.requests += 1
+        self.stats.reserved_tokens += tokens_n
+        if self._idle_since is not None:
+            self.stats.idle += time.monotonic() - self._idle_since
+            self._idle_since = None
+
+    def _next_release(self, tokens_n: int) -> float:
+        """Monotonic time at which the window will have freed enough budget for tokens_n,
+        inf if it depends on running requests completing"""
+        requests, tokens = self._minute_requests, self._minute_tokens
+        for entry in self._completed_log:
+            if requests < self.rpm and tokens + tokens_n <= self.tpm:
+                break
+            requests -= 1
+            tokens -= entry.tokens
+            release = entry.time + self._window
+        else:
+            if not (requests < self.rpm and tokens + tokens_n <= self.tpm):
+                return inf
+        release = release if requests != self._minute_requests else time.monotonic()
+        return max(release, self._paused_until)
+
+    def _wake_waiters(self):
+        """Admit queued requests in priority order while budget allows,
+        then schedule a wakeup for when the window frees budget for the next one"""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        self._clean_window()
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.future.done(): # cancelled while in queue
+                heapq.heappop(self._waiters)
+                continue
+            if not self._can_start(waiter.tokens):
+                break
+            heapq.heappop(self._waiters)
+            self._start(waiter.tokens)
+            waiter.future.set_result(None)
+
+        if self._waiters and self._running == 0 and self._idle_since is None:
+            self._idle_since = time.monotonic()
+
+        if not self._waiters or self._running >= self.max_concurrent_requests:
+            return # next wakeup comes from a completion
+
+        release = self._next_release(self._waiters[0].tokens)
+        if release == inf:
+            return
+
+        delay = max(release - time.monotonic(), 0) + 0.001 # window is strictly greater than
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._wake_waiters)
+        if self._running == 0 and not self._waiting_warning:
+            logger.warning(f"Waiting {max(int(delay), 1)} seconds for rate limits")
             self._waiting_warning = True
 
-        return False
+    async def _acquire(self, request_id: str, tokens_n: int, retry: bool = False) -> float:
+        """Wait for budget to start a request, return the seconds waited"""
+        self._clean_window()
+        if not self._waiters and self._can_start(tokens_n):
+            self._start(tokens_n)
+            return 0.0
+
+        logger.verbose(f"{request_id}: in queue")
+        # retries already waited their turn
+        priority = (-inf,) if retry else request_priority.get()
+        waiter = Waiter(priority, next(self._arrivals), tokens_n, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, waiter)
+        self._wake_waiters()
+        queued = time.monotonic()
+        try:
+            await waiter.future
+            waited = time.monotonic() - queued
+            self.stats.queue_wait += waited
+            return waited
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._complete(tokens_n) # admitted right before being cancelled
+            else:
+                self._wake_waiters() # let the next waiter in if this was the queue head
+            raise
 
-    def _complete(self, tokens_n: int) -> bool:
+    def _complete(self, tokens_n: int, used_tokens: int = None) -> bool:
+        """Release a running request, charging the tokens actually used in place of the reserved ones if known"""
         self._running -= 1
-        self._completed_log.append(
-            LogEntry(datetime.now(tz=timezone.utc), tokens_n))
-        logger.debug(f"Completed {tokens_n} tokens")
+        if used_tokens is not None:
+            self._minute_tokens += used_tokens - tokens_n
+            tokens_n = used_tokens
+        self.stats.used_tokens += tokens_n
+        self._completed_log.append(LogEntry(time.monotonic(), tokens_n))
+        logger.verbose(f"Completed {tokens_n} tokens")
+        self._wake_waiters()
         return True
 
-    async def ask(
-            self, request_id: str, text: str, _retry: int = 0) -> str:
-        tokens = int(self.client.estimate_question_tokens(text) * 2.1)
+    @property
+    def model(self) -> str:
+        return self.client.model
 
-        queued = False
-        complete = False
-        while not self._try_start(tokens):
-            if not queued:
-                queued = True
-                logger.info(f"{request_id}: in queue")
-            await asyncio.sleep(2)
+    @property
+    def prompt(self) -> str:
+        return self.client.prompt
 
+    @property
+    def paused_until(self) -> float:
+        return self._paused_until
+
+    def free_budget(self) -> float:
+        """Fraction of the window budget still available, reduced by the requests already in queue"""
+        self._clean_window()
+        return (
+            min((self.rpm - self._minute_requests) / self.rpm, (self.tpm - self._minute_tokens) / self.tpm)
+            - len(self._waiters) / self.rpm)
+
+    def usage(self) -> tuple[float, float, int]:
+        """Fraction of the window requests and tokens in use, and the number of requests waiting for budget"""
+        self._clean_window()
+        return self._minute_requests / self.rpm, self._minute_tokens / self.tpm, len(self._waiters)
+
+    async def close(self):
+        self.estimator.save()
+        if hasattr(self.client, 'release_cache'):
+            await self.client.release_cache()
+
+    def _estimate_tokens(self, text: str) -> int:
+        # a single request larger than the budget would wait forever
+        return min(self.estimator.estimate(text), self.tpm)
+
+    def _back_off(self, request_id: str, ex: RetriableException, admitted: float):
+        """Pause admissions with jittered exponential backoff on consecutive retriable errors,
+        at least for the delay suggested by the server.
+
+        A quota burst fails every request in flight: only the requests admitted after the last pause
+        ended escalate the backoff, the ones admitted before it belong to the same burst and at most
+        extend the pause to the delay suggested by the server."""
+        now = time.monotonic()
+        if admitted < self._paused_until:
+            if ex.retry_after is not None and now + ex.retry_after > self._paused_until:
+                self.stats.backoff_time += now + ex.retry_after - max(self._paused_until, now)
+                self._paused_until = now + ex.retry_after
+            logger.verbose(f"{request_id}: {ex} - requests already paused")
+            return
+
+        self._failures += 1
+        delay = min(self.backoff_base * 2 ** (self._failures - 1), self.backoff_max) * random.uniform(0.5, 1)
+        if ex.retry_after is not None:
+            delay = max(delay, ex.retry_after)
+        if now + delay > self._paused_until:
+            self.stats.backoff_time += now + delay - max(self._paused_until, now)
+            self._paused_until = now + delay
+        self.stats.backoffs += 1
+        logger.warning(f"{request_id}: {ex} - pausing requests for {delay:.1f} seconds")
+
+    def _succeeded(self, admitted: float):
+        if admitted >= self._paused_until: # not a request of the burst that caused the last pause
+            self._failures = 0
+
+    async def _request(
+            self,
+            request_id: str,
+            text: str,
+            call: Callable[[], Awaitable[tuple[Any, TokenUsage]]]) -> Any:
+        if self.seed_estimates and not self.estimator.seeded:
+            await self.estimator.seed(text)
+
+        tokens = self._estimate_tokens(text)
+        record = telemetry.RequestRecord(request_id, self.model, tokens)
         try:
-            logger.info(f"{request_id}: calling Gemini")
-            return await self.client.ask(text)
-
-        except RetriableException as ex:
-            if _retry < self.max_retries:
-                logger.warning(f"{request_id}: rescheduling after - {ex}")
-                if not complete: complete = self._complete(tokens)
-                return await self.ask(request_id, text, _retry + 1)
-            else:
-                raise
+            for retry in range(self.max_retries + 1):
+                record.queue_wait += await self._acquire(request_id, tokens, retry > 0)
+                record.retries = retry
+                usage = None
+                try:
+                    logger.verbose(f"{request_id}: calling Gemini")
+                    begin = time.monotonic()
+                    result, usage = await call()
+                    record.latency = time.monotonic() - begin
+                    request_latency.set(record.latency)
+                    record.add_usage(usage)
+                    record.status = "ok"
+                    self.estimator.update(text, usage)
+                    self.stats.cached_tokens += usage.cached_tokens if usage else 0
+                    self._succeeded(begin)
+                    return result
 
+                except RetriableException as ex:
+                    self._back_off(request_id, ex, begin)
+                    if retry == self.max_retries:
+                        raise
+                    logger.warning(f"{request_id}: rescheduling")
+                    self.stats.retries += 1
+
+                finally:
+                    self._complete(tokens, self.estimator.charged(usage) if usage else None)
         finally:
-            if not complete: self._complete(tokens)
+            telemetry.record_request(record)
 
-    async def structured_output(
-            self, request_id: str, text: str, structure: Structure, _retry: int = 0) -> Structure:
-        tokens = int(self.client.estimate_question_tokens(text) * 2.1)
+    async def ask(self, request_id: str, text: str) -> str:
+        return await self._request(
+            request_id, text, lambda: self.client.ask(text))
 
-        queued = False
-        complete = False
-        while not self._try_start(tokens):
-            if not queued:
-                queued = True
-                logger.info(f"{request_id}: in queue")
-            await asyncio.sleep(2)
+    async def ask_stream(self, request_id: str, text: str) -> AsyncIterator[str]:
+        """Yield the response text as it is generated. A retriable error is retried only
+        if no text has been yielded yet, closing the iterator early releases the request"""
+        if self.seed_estimates and not self.estimator.seeded:
+            await self.estimator.seed(text)
 
+        tokens = self._estimate_tokens(text)
+        record = telemetry.RequestRecord(request_id, self.model, tokens)
         try:
-            logger.info(f"{request_id}: calling Gemini")
-            return await self.client.structured_output(text, structure)
-
-        except RetriableException as ex:
-            if _retry < self.max_retries:
-                logger.warning(f"{request_id}: rescheduling after - {ex}")
-                if not complete: complete = self._complete(tokens)
-                return await self.structured_output(request_id, text, structure, _retry + 1)
-            else:
-                raise
+            for retry in range(self.max_retries + 1):
+                record.queue_wait += await self._acquire(request_id, tokens, retry > 0)
+                record.retries = retry
+                usage = None
+                started = False
+                try:
+                    logger.verbose(f"{request_id}: calling Gemini (streaming)")
+                    begin = time.monotonic()
+                    async for piece, piece_usage in self.client.ask_stream(text):
+                        usage = piece_usage or usage
+                        started = True
+                        yield piece
+                    record.latency = time.monotonic() - begin
+                    record.add_usage(usage)
+                    record.status = "ok"
+                    self.estimator.update(text, usage)
+                    self.stats.cached_tokens += usage.cached_tokens if usage else 0
+                    self._succeeded(begin)
+                    return
+
+                except RetriableException as ex:
+                    self._back_off(request_id, ex, begin)
+                    if started or retry == self.max_retries:
+                        raise
+                    logger.warning(f"{request_id}: rescheduling")
+                    self.stats.retries += 1
+
+                except GeneratorExit:
+                    record.status = "closed"
+                    raise
 
+                finally:
+                    self._complete(tokens, self.estimator.charged(usage) if usage else None)
         finally:
-            if not complete: self._complete(tokens)
\ No newline at end of file
+            telemetry.record_request(record)
+
+    async def structured_output(
+            self, request_id: str, text: str, structure: Structure) -> Structure:
+        return await self._request(
+            request_id, text, lambda: self.client.structured_output(text, structure))
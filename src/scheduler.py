@@ -0,0 +1,126 @@
+import time
+import heapq
+import asyncio
+
+from itertools import count
+from math import inf
+from typing import Callable, Awaitable, Any, AsyncIterator
+
+from src.gemini import Structure
+from src.rate_limiter import RateLimitedLLM, request_priority
+from src.llm_pool import LLMPool
+from src.telemetry import current_file, admission_wait
+
+policies = ("fifo", "shortest", "deadline")
+
+class RequestScheduler:
+    """Admits the requests of all files to the llm in priority order, at most `max_in_flight` at a time.
+
+    Requests beyond `max_in_flight` wait in a priority queue ordered by `policy`:
+    - fifo: the files that started first, so files complete one after the other
+    - shortest: the files with fewer lines, so the most files complete early
+    - deadline: each file is due `deadline_per_line` seconds per line after it started, short files
+      go first without starving the long ones
+    Requests of the same priority keep their order, requests outside a file go last. The priority is
+    also passed to the rate limiters, which admit their queued requests in the same order.
+    """
+
+    def __init__(
+            self,
+            llm: RateLimitedLLM | LLMPool,
+            max_in_flight: int,
+            policy: str = "fifo",
+            deadline_per_line: float = 0.1):
+        if policy not in policies: raise ValueError(f"Unknown scheduling policy {policy}, use one of {', '.join(policies)}")
+        self.llm = llm
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.deadline_per_line = deadline_per_line
+
+        self._in_flight = 0
+        self._queue: list[tuple[tuple, int, asyncio.Future]] = [] # heap of (priority, arrival, future)
+        self._arrivals = count()
+
+    @property
+    def model(self) -> str:
+        return self.llm.model
+
+    @property
+    def prompt(self) -> str:
+        return self.llm.prompt
+
+    @property
+    def stats(self):
+        return self.llm.stats
+
+    async def close(self):
+        await self.llm.close()
+
+    def _priority(self) -> tuple:
+        file = current_file.get()
+        if file is None:
+            return (inf,)
+        if self.policy == "shortest":
+            return (file.lines, file.order)
+        if self.policy == "deadline":
+            return (file.started + file.lines * self.deadline_per_line, file.order)
+        return (file.order,)
+
+    async def _admit(self, priority: tuple):
+        if self._in_flight < self.max_in_flight and not self._queue:
+            self._in_flight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release() # admitted right before being cancelled
+            raise
+
+    def _release(self):
+        self._in_flight -= 1
+        while self._queue and self._in_flight < self.max_in_flight:
+            _, _, future = heapq.heappop(self._queue)
+            if future.done(): # cancelled while in queue
+                continue
+            self._in_flight += 1
+            future.set_result(None)
+
+    async def _request(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        priority = self._priority()
+        queued = time.monotonic()
+        await self._admit(priority)
+        token = request_priority.set(priority)
+        wait_token = admission_wait.set(time.monotonic() - queued)
+        try:
+            return await call()
+        finally:
+            admission_wait.reset(wait_token)
+            request_priority.reset(token)
+            self._release()
+
+    async def ask(self, request_id: str, text: str) -> str:
+        return await self._request(lambda: self.llm.ask(request_id, text))
+
+    async def structured_output(
+            self, request_id: str, text: str, structure: Structure) -> Structure:
+        return await self._request(lambda: self.llm.structured_output(request_id, text, structure))
+
+    async def ask_stream(self, request_id: str, text: str) -> AsyncIterator[str]:
+        priority = self._priority()
+        queued = time.monotonic()
+        await self._admit(priority)
+        token = request_priority.set(priority)
+        wait_token = admission_wait.set(time.monotonic() - queued)
+        stream = self.llm.ask_stream(request_id, text)
+        try:
+            async for piece in stream:
+                yield piece
+        finally:
+            await stream.aclose()
+            admission_wait.reset(wait_token)
+            request_priority.reset(token)
+            self._release()
@@ -0,0 +1,50 @@
+import re
+
+from collections import Counter
+from itertools import count
+from string import ascii_uppercase
+from typing import Iterable
+
+speaker_regex = re.compile(r'([^:\n]{1,40}): ')
+
+def _ids() -> Iterable[str]:
+    for length in count(1):
+        for i in range(len(ascii_uppercase) ** length):
+            id = ''
+            for _ in range(length):
+                i, r = divmod(i, len(ascii_uppercase))
+                id = ascii_uppercase[r] + id
+            yield id
+
+class SpeakerTable:
+    """Speakers of the lines of a request, abbreviated with short ids.
+
+    The 'Name: ' prefixes repeated in the lines are replaced with 'A: ', 'B: '... and the table is sent
+    once before the lines. Only names longer than their id and appearing more than once are abbreviated,
+    ids never clash with a prefix already in the lines, so decoding restores the lines exactly.
+    """
+
+    def __init__(self, lines: Iterable[str] = ()):
+        prefixes = Counter(m.group(1) for line in lines if (m := speaker_regex.match(line)))
+        ids = (id for id in _ids() if id not in prefixes)
+        self.ids: dict[str, str] = {
+            name: next(ids) for name, n in prefixes.most_common() if n > 1 and len(name) > 2}
+        self.names: dict[str, str] = {id: name for name, id in self.ids.items()}
+
+    def header(self) -> str:
+        if not self.ids:
+            return ''
+        table = ', '.join(f"{id} = {name}" for id, name in self.names.items())
+        return f"Speakers are abbreviated at the start of the lines as: {table}\n\n"
+
+    def _replace(self, line: str, table: dict[str, str]) -> str:
+        m = speaker_regex.match(line)
+        if m and m.group(1) in table:
+            return f"{table[m.group(1)]}: {line[m.end():]}"
+        return line
+
+    def encode(self, line: str) -> str:
+        return self._replace(line, self.ids)
+
+    def decode(self, line: str) -> str:
+        return self._replace(line, self.names)
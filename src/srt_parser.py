@@ -1,19 +1,123 @@
+import io
+import re
+
+from typing import TextIO, Iterator, NamedTuple, Optional
+
 from src.models import TranslationFile
 
+index_regex = re.compile(r'\s*\d+\s*')
+blank_line_regex = re.compile(r'^\s*$', re.MULTILINE)
+timing_regex = re.compile(r'\s*\d+:\d\d?:\d\d?[,.]\d{1,3}[ \t]*-->[ \t]*\d+:\d\d?:\d\d?[,.]\d{1,3}.*?\s*')
+
+space_line_regex = re.compile(r'^[^\S\n]+$', re.MULTILINE)
+
+class SrtBlock(NamedTuple):
+    timing: str # timing line as in the file, with its position like 'X1:100 X2:200 Y1:10 Y2:50' if any
+    text: str
+
+def _chunks(text: str) -> Iterator[str]:
+    start = 0
+    while (end := text.find('\n\n', start)) != -1:
+        yield text[start:end]
+        start = end + 2
+    yield text[start:]
+
+def srt_blocks(text: str) -> Iterator[SrtBlock]:
+    """Parse .srt blocks with any line ending in a single pass.
+
+    A block starts at a timing line, its index line is optional, and its text runs until the
+    next block. Blank lines, a leading BOM and lines before the first block are dropped,
+    blocks without text are skipped. Well formed blocks are parsed whole, the rest line by line.
+    """
+    text = text.lstrip('\ufeff')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+    timing: str = None # timing line of the current block
+    lines: list[str] = []
+    index: str = None # index line held until it is known if a timing follows it
+
+    for chunk in _chunks(text):
+        parts = chunk.split('\n', 2)
+        if (len(parts) == 3 and parts[0].isdigit() and '-->' not in parts[2]
+                and not blank_line_regex.search(parts[2]) and timing_regex.fullmatch(parts[1])):
+            if timing and lines:
+                yield SrtBlock(timing, '\n'.join(lines))
+            timing, lines = parts[1].strip(), [parts[2]]
+            continue
+
+        for line in chunk.split('\n'):
+            if '-->' in line and timing_regex.fullmatch(line):
+                if timing and lines:
+                    yield SrtBlock(timing, '\n'.join(lines))
+                timing, lines, index = line.strip(), [], None
+                continue
+            if index is not None:
+                lines.append(index)
+                index = None
+            if line.isdigit() or index_regex.fullmatch(line):
+                index = line
+            elif line and not line.isspace():
+                lines.append(line)
+        if index is not None:
+            lines.append(index)
+            index = None
+
+    if timing and lines:
+        yield SrtBlock(timing, '\n'.join(lines))
+
+def well_formed_blocks(text: str) -> Optional[tuple[list[str], list[str]]]:
+    """Timing lines and texts of the blocks, when every block is an index, a timing and text lines
+    separated by single blank lines with '\n' line endings, as most files are. None otherwise, to be
+    parsed by srt_blocks. The checks run on the whole text where possible, not block by block."""
+    if '\r' in text or text.startswith('\ufeff'):
+        return None
+    if ('\n ' in text or '\n\t' in text) and space_line_regex.search(text): # lines blank but for spaces
+        return None
+    blocks = [block.split('\n', 2) for block in text.rstrip('\n').split('\n\n')]
+    if text.count('-->') != len(blocks) or not all(len(parts) == 3 and parts[0].isdigit() for parts in blocks):
+        return None
+    timings = [parts[1] for parts in blocks]
+    if not all(map(timing_regex.fullmatch, timings)):
+        return None
+    return timings, [parts[2] for parts in blocks]
+
 class SrtTranslationFile(TranslationFile):
 
     def __init__(self, text: str):
-        blocks = text.split('\n\n')
-        splitted = [b.split('\n', 2) for b in blocks]
-        self._dialogue: list[str] = [l[-1] for l in splitted]
-        self._timestamps: list[str] = ['\n'.join(l[:2]) for l in splitted]
+        blocks = well_formed_blocks(text)
+        if blocks is None:
+            blocks = [], []
+            for block in srt_blocks(text):
+                blocks[0].append(block.timing)
+                blocks[1].append(block.text)
+        self._timings: list[str] = blocks[0] # timing line of each block as in the file, with its position
+        self._dialogue: list[str] = blocks[1]
 
     def get_dialogue(self):
         return self._dialogue
 
+    def get_texts(self) -> list[str]:
+        return self._dialogue
+
     def map_dialogue_lines(self, lines: list[int]) -> list[int]:
         return list(lines)
 
+    def write_translation(
+            self, translation: list[str], fp: TextIO, texts: list[Optional[str]] = None, buffer_blocks: int = 1000):
+        """Write the final file to fp, buffer_blocks blocks at a time, renumbering the blocks from 1"""
+        if len(self._dialogue) != len(translation): raise Exception("Lines count mismatch")
+        if texts:
+            translation = [line if kept is None else kept for line, kept in zip(translation, texts)]
+        timings = self._timings
+        for first in range(0, len(translation), buffer_blocks):
+            fp.write('\n\n'.join([
+                f"{i + 1}\n{timings[i]}\n{translation[i]}"
+                for i in range(first, min(first + buffer_blocks, len(translation)))]))
+            if first + buffer_blocks < len(translation):
+                fp.write('\n\n')
+
     def get_translation(self, translation: list[str]):
-        if len(self._timestamps) != len(translation): raise Exception("Lines count mismatch")
-        return '\n\n'.join([f"{f}\n{l}" for f, l in zip(self._timestamps, translation)])
\ No newline at end of file
+        out = io.StringIO()
+        self.write_translation(translation, out)
+        return out.getvalue()
@@ -0,0 +1,236 @@
+"""Structured records of the requests and files of a run.
+
+Each request sent by a RateLimitedLLM and each file translated is recorded with its queue waits,
+api latency, estimated and used tokens, retries, halvings and misaligned lines. Records are
+appended to a jsonl file as they complete, if set, and summed up at the end of the run in a
+summary and a prometheus textfile. Requests are attributed to the file of the task sending them.
+"""
+import os
+import json
+import time
+
+from contextvars import ContextVar
+from collections import Counter
+from dataclasses import dataclass, asdict
+from typing import Optional, TextIO
+
+from src.models import TokenUsage
+import src.logger as logger
+
+@dataclass
+class FileInfo:
+    order: int # position of the file in the run
+    lines: int
+    started: float # monotonic time the file started translating
+    name: str = None
+
+# file whose requests are sent by the current task, set by the file task and inherited by the translator tasks
+current_file: ContextVar[FileInfo] = ContextVar('current_file', default=None)
+# seconds the request of the current task waited for a slot of the RequestScheduler
+admission_wait: ContextVar[float] = ContextVar('admission_wait', default=0.0)
+
+@dataclass
+class RequestRecord:
+    request_id: str
+    model: str
+    estimated_tokens: int
+    file: str = None
+    admission_wait: float = 0 # seconds waiting for a slot of the RequestScheduler
+    queue_wait: float = 0 # seconds waiting for rate limits, summed over retries
+    latency: float = None # seconds of the api call that completed, None if none did
+    used_tokens: int = None # tokens reported by gemini
+    cached_tokens: int = 0
+    retries: int = 0
+    status: str = "failed" # "ok", "failed" or "closed" for streams closed before their end
+
+    def add_usage(self, usage: Optional[TokenUsage]):
+        if usage:
+            self.used_tokens = usage.total
+            self.cached_tokens = usage.cached_tokens
+
+@dataclass
+class FileRecord:
+    file: str
+    lines: int = 0
+    translated_lines: int = 0
+    requests: int = 0
+    admission_wait: float = 0
+    queue_wait: float = 0
+    latency: float = 0 # seconds of api calls, summed over requests
+    estimated_tokens: int = 0
+    used_tokens: int = 0
+    retries: int = 0
+    halvings: int = 0
+    misaligned_lines: int = 0 # misaligned in the responses, repaired or not
+    unresolved_lines: int = 0 # still misaligned in the translated file
+    started: float = None # epoch seconds
+    elapsed: float = 0
+    status: str = "ok"
+
+    def add(self, record: RequestRecord):
+        self.requests += 1
+        self.admission_wait += record.admission_wait
+        self.queue_wait += record.queue_wait
+        self.latency += record.latency or 0
+        self.estimated_tokens += record.estimated_tokens
+        self.used_tokens += record.used_tokens or 0
+        self.retries += record.retries
+
+_fp: TextIO = None
+_started = time.monotonic()
+_files: dict[int, FileRecord] = {} # files being translated, by order
+totals = FileRecord(file=None)
+latencies: list[float] = []
+queue_waits: list[float] = []
+requests_by_status: Counter[tuple[str, str]] = Counter() # (model, status)
+files_by_status: Counter[str] = Counter()
+
+def start(path: str = None):
+    """Reset the records for a new run, appending them to the jsonl file at path if set"""
+    global _fp, _started, totals
+    close()
+    _started = time.monotonic()
+    _files.clear()
+    totals = FileRecord(file=None)
+    latencies.clear()
+    queue_waits.clear()
+    requests_by_status.clear()
+    files_by_status.clear()
+    if path:
+        _fp = open(path, 'a', encoding='utf-8')
+
+def close():
+    global _fp
+    if _fp is not None:
+        _fp.close()
+        _fp = None
+
+def _write(kind: str, record: dict):
+    if _fp is not None:
+        _fp.write(json.dumps({'type': kind, 'time': round(time.time(), 3), **record}, ensure_ascii=False) + '\n')
+
+def _current() -> Optional[FileRecord]:
+    file = current_file.get()
+    if file is None:
+        return None
+    if file.order not in _files:
+        _files[file.order] = FileRecord(file.name, file.lines, started=time.time())
+    return _files[file.order]
+
+def record_request(record: RequestRecord):
+    file = _current()
+    record.file = file.file if file else None
+    record.admission_wait = admission_wait.get()
+    if file: file.add(record)
+    totals.add(record)
+    if record.latency is not None:
+        latencies.append(record.latency)
+    queue_waits.append(record.admission_wait + record.queue_wait)
+    requests_by_status[record.model, record.status] += 1
+    _write('request', asdict(record))
+
+def record_halving(request_id: str, size: int):
+    """The request was split in two halves of size/2 lines or chunks"""
+    if file := _current(): file.halvings += 1
+    totals.halvings += 1
+    _write('halving', {'request_id': request_id, 'file': file.file if file else None, 'size': size})
+
+def record_misalignment(request_id: str, lines: int):
+    if file := _current(): file.misaligned_lines += lines
+    totals.misaligned_lines += lines
+    _write('misalignment', {'request_id': request_id, 'file': file.file if file else None, 'lines': lines})
+
+def record_progress(lines: int):
+    """Lines of the current file translated, or served from journal or memory"""
+    if file := _current(): file.translated_lines += lines
+    totals.translated_lines += lines
+
+def open_files() -> list[FileRecord]:
+    """Files being translated, in the order they started"""
+    return list(_files.values())
+
+def started() -> float:
+    """Monotonic time of the start of the run"""
+    return _started
+
+def file_started(info: FileInfo):
+    _files[info.order] = FileRecord(info.name, info.lines, started=time.time())
+
+def file_finished(order: int, name: str, status: str = "ok", unresolved_lines: int = 0):
+    file = _files.pop(order, None) or FileRecord(name)
+    file.status = status
+    file.unresolved_lines = unresolved_lines
+    file.elapsed = time.time() - file.started if file.started is not None else 0
+    totals.unresolved_lines += unresolved_lines
+    files_by_status[status] += 1
+    _write('file', asdict(file))
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def budget_utilisation(limiter) -> tuple[float, float]:
+    """Fraction of the request and token budget of a RateLimitedLLM used since the start of the run"""
+    # the most budget a sliding window allows in the run, a full window at the start and one per window after
+    windows = (time.monotonic() - _started) // limiter.wait_window.total_seconds() + 1
+    return (
+        limiter.stats.requests / (limiter.rpm * windows),
+        limiter.stats.used_tokens / (limiter.tpm * windows))
+
+def summary(limiters: list) -> list[str]:
+    ok = sum(n for (_, status), n in requests_by_status.items() if status == "ok")
+    lines = [
+        f"Requests: {totals.requests} ({ok} ok, {totals.retries} retries),"
+        f" latency p50 {percentile(latencies, 0.5):.1f}s p95 {percentile(latencies, 0.95):.1f}s,"
+        f" queue wait p50 {percentile(queue_waits, 0.5):.1f}s p95 {percentile(queue_waits, 0.95):.1f}s",
+        f"Tokens: {totals.estimated_tokens} estimated, {totals.used_tokens} used"
+        + (f" ({totals.used_tokens / totals.estimated_tokens:.2f}x)" if totals.estimated_tokens else ''),
+        f"Halvings: {totals.halvings}, misaligned lines: {totals.misaligned_lines}"
+        f" ({totals.unresolved_lines} left in the translated files)",
+    ]
+    for limiter in limiters:
+        requests, tokens = budget_utilisation(limiter)
+        lines.append(f"{limiter.model} budget used: {requests:.0%} of requests, {tokens:.0%} of tokens")
+    return lines
+
+def write_metrics(path: str, limiters: list):
+    """Write the totals of the run as a prometheus textfile, replacing it at once"""
+    prefix = 'translate_subs'
+    out = []
+    def metric(name: str, kind: str, help: str, samples: list[tuple[str, float]]):
+        out.append(f"# HELP {prefix}_{name} {help}")
+        out.append(f"# TYPE {prefix}_{name} {kind}")
+        out.extend(f"{prefix}_{name}{labels} {value}" for labels, value in samples)
+
+    def quantiles(values: list[float]) -> list[tuple[str, float]]:
+        return [
+            ('{quantile="0.5"}', percentile(values, 0.5)),
+            ('{quantile="0.95"}', percentile(values, 0.95)),
+            ('_sum', sum(values)),
+            ('_count', len(values))]
+
+    metric('requests_total', 'counter', "Requests sent to gemini by model and status", [
+        (f'{{model="{model}",status="{status}"}}', n) for (model, status), n in sorted(requests_by_status.items())])
+    metric('request_retries_total', 'counter', "Requests sent again after a retriable error", [('', totals.retries)])
+    metric('request_latency_seconds', 'summary', "Api latency of the requests", quantiles(latencies))
+    metric('request_queue_wait_seconds', 'summary', "Time requests waited for a slot and for rate limits", quantiles(queue_waits))
+    metric('tokens_total', 'counter', "Tokens estimated before the requests and used by them", [
+        ('{kind="estimated"}', totals.estimated_tokens), ('{kind="used"}', totals.used_tokens)])
+    metric('halvings_total', 'counter', "Requests split in two after a misaligned or invalid response", [('', totals.halvings)])
+    metric('misaligned_lines_total', 'counter', "Lines misaligned in the responses", [('', totals.misaligned_lines)])
+    metric('unresolved_lines_total', 'counter', "Lines left misaligned in the translated files", [('', totals.unresolved_lines)])
+    metric('files_total', 'counter', "Files translated by status", [
+        (f'{{status="{status}"}}', n) for status, n in sorted(files_by_status.items())])
+    budget = [(i, limiter.model, *budget_utilisation(limiter)) for i, limiter in enumerate(limiters)]
+    metric('budget_utilisation', 'gauge', "Fraction of the rate limits budget used during the run", [
+        (f'{{backend="{i}",model="{model}",resource="{resource}"}}', value)
+        for i, model, requests, tokens in budget
+        for resource, value in (("requests", requests), ("tokens", tokens))])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        fp.write('\n'.join(out) + '\n')
+    os.replace(tmp_path, path)
+    logger.debug(f"Metrics written to {path}")
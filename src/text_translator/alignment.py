@@ -0,0 +1,33 @@
+import re
+
+from collections import Counter
+from typing import Iterable
+
+numbered_regex = re.compile(r'\s*Line\s+(\d+)\s*-\s*')
+
+def parse_numbered(response: str) -> list[tuple[int, str]]:
+    """Split a response in (line number, text) records"""
+    parts = numbered_regex.split(response)
+    return [(int(parts[i]), parts[i + 1]) for i in range(1, len(parts), 2)]
+
+def align_numbered(
+        records: list[tuple[int, str]], expected: Iterable[int]) -> tuple[dict[int, str], list[int]]:
+    """Match the records to the expected line numbers.
+
+    Return the aligned lines and the broken ones: lines missing or returned more than once (split),
+    and lines next to a missing one, as they may contain it merged.
+    """
+    expected = list(expected)
+    counts = Counter(n for n, _ in records)
+    aligned = {n: text for n, text in records if counts[n] == 1}
+
+    missing = {n for n in expected if n not in counts}
+    suspects = {m for n in missing for m in (n - 1, n + 1)}
+    broken = [n for n in expected if counts[n] != 1 or n in suspects]
+    return {n: aligned[n] for n in expected if n in aligned and n not in suspects}, broken
+
+def with_context(lines: Iterable[int], context: int, count: int) -> list[int]:
+    """Line numbers including `context` lines around each one, within [0, count)"""
+    return sorted({
+        m for n in lines
+        for m in range(max(n - context, 0), min(n + context + 1, count))})
@@ -3,47 +3,112 @@ import traceback
 import re
 
 from string import Template
+from typing import Iterable
 from math import ceil
 from itertools import chain
 
 from src.models import *
-from src.rate_limiter import RateLimitedLLM
+from src.rate_limiter import RateLimitedLLM, request_latency
+from src.translation_memory import TranslationMemory
+from src.token_chunker import TokenChunker
+from src.chunk_controller import ChunkSizeController
+from src.speaker_table import SpeakerTable
+from src.text_translator.alignment import numbered_regex, parse_numbered, align_numbered, with_context
 import src.logger as logger
+import src.telemetry as telemetry
 
 from importlib import resources
 
 prompt = Template(resources.files(__package__).joinpath("prompt.md").read_text())
 split_regex = re.compile(r'\s*Line\s+\d+\s*-\s*')
 
+class LineStreamParser:
+    """Incrementally parse 'Line N - ' records from a streamed response.
+
+    A record is complete once the next marker arrives, parsing stops at the first record
+    whose number is not the expected one.
+    """
+
+    def __init__(self, first_line: int, last_line: int):
+        self.next_line = first_line
+        self.last_line = last_line # excluded
+        self.lines: list[str] = []
+        self.diverged = False
+        self._buffer = ''
+
+    def _accept(self, number: int, text: str) -> bool:
+        if number != self.next_line or number >= self.last_line:
+            self.diverged = True
+            return False
+        self.lines.append(text)
+        self.next_line += 1
+        return True
+
+    def feed(self, text: str):
+        if self.diverged: return
+        self._buffer += text
+        markers = list(numbered_regex.finditer(self._buffer))
+        for m, following in zip(markers, markers[1:]):
+            if not self._accept(int(m.group(1)), self._buffer[m.end():following.start()]):
+                return
+        if markers:
+            self._buffer = self._buffer[markers[-1].start():]
+
+    def finish(self):
+        """Complete the last record at the end of the stream"""
+        if self.diverged: return
+        m = numbered_regex.match(self._buffer)
+        if m:
+            self._accept(int(m.group(1)), self._buffer[m.end():].rstrip())
+
 class TextTranslator:
 
     def __init__(
             self,
             llm: RateLimitedLLM,
-            chunk_lines: int):
+            chunk_lines: int,
+            memory: TranslationMemory = None,
+            streaming: bool = False,
+            repair_context: int = 2,
+            repair_attempts: int = 2,
+            chunker: TokenChunker = None,
+            controller: ChunkSizeController = None,
+            speaker_table: bool = False):
         self.llm = llm
         self.chunk_lines = chunk_lines
+        self.chunker = chunker # requests sized by tokens, at most chunk_lines lines
+        self.controller = controller # lines per request tuned at runtime, at most chunk_lines
+        self.memory = memory
+        self.streaming = streaming
+        self.repair_context = repair_context
+        self.repair_attempts = repair_attempts
+        self.speaker_table = speaker_table # speaker names abbreviated in each request
 
-    async def __call__(self, filename: str, dialogue: list[str]) -> TranslationOutput:
+    async def __call__(
+            self, filename: str, dialogue: list[str], journal: TranslationJournal = None) -> TranslationOutput:
         translated = await self._split_and_translate(
-            filename, dialogue, self.chunk_lines)
+            filename, dialogue, self._chunk_lines(), journal)
 
         return TranslationOutput(filename, translated)
 
     async def _split_and_translate(
-            self, chunk_id: str, dialogue: list[str], chunk_lines: int) -> list[str]:
+            self, chunk_id: str, dialogue: list[str], chunk_lines: int,
+            journal: TranslationJournal = None) -> list[str]:
 
-        blocks = ceil(len(dialogue)/chunk_lines)
-        q, r = divmod(len(dialogue), blocks)
-        chunks = [
-            dialogue[i*q + min(i, r):(i+1)*q + min(i+1, r)]
-            for i in range(blocks)]
+        if self.chunker is not None:
+            chunks = self.chunker.split(dialogue, chunk_lines)
+        else:
+            blocks = ceil(len(dialogue)/chunk_lines)
+            q, r = divmod(len(dialogue), blocks)
+            chunks = [
+                dialogue[i*q + min(i, r):(i+1)*q + min(i+1, r)]
+                for i in range(blocks)]
 
         chunk_id = f"{chunk_id}.{{}}" if len(chunks) > 1 else chunk_id
         try:
             async with asyncio.TaskGroup() as tg:
                 tasks = [
-                    tg.create_task(self._translate_block(chunk_id.format(i+1), chunk))
+                    tg.create_task(self._translate_block(chunk_id.format(i+1), chunk, journal))
                     for i, chunk in enumerate(chunks)]
 
         except* Exception as exs:
@@ -52,15 +117,142 @@ class TextTranslator:
         return list(chain.from_iterable(t.result() for t in tasks))
 
     async def _translate_block(
-            self, chunk_id: str, dialogue: list[str]) -> list[str]:
-        text = '\n'.join([f"Line {i} - {line}" for i, line in enumerate(dialogue)])
-        question = prompt.substitute(lines_per_chunk= self.chunk_lines, text= text)
+            self, chunk_id: str, dialogue: list[str], journal: TranslationJournal = None) -> list[str]:
+        if journal is not None and (lines := journal.get(dialogue)) is not None:
+            logger.info(f"{chunk_id}: resumed from journal")
+            telemetry.record_progress(len(dialogue))
+            return lines
+
+        if self.memory is None:
+            lines = await self._request_block(chunk_id, dialogue, journal)
+        else:
+            requested = 0
+            async def request_missing(missing: list[str]) -> list[str]:
+                nonlocal requested
+                requested = len(missing)
+                if len(missing) < len(dialogue):
+                    logger.info(f"{chunk_id}: {len(dialogue) - len(missing)} lines served from translation memory")
+                return await self._request_block(chunk_id, missing, journal)
+
+            lines = await self.memory.serve(dialogue, request_missing)
+            telemetry.record_progress(len(dialogue) - requested) # requested lines are counted by their requests
+
+        if journal is not None:
+            journal.record(dialogue, lines)
+        return lines
+
+    def _chunk_lines(self) -> int:
+        return self.controller.size if self.controller else self.chunk_lines
+
+    def _question(self, numbered: Iterable[tuple[int, str]]) -> tuple[str, SpeakerTable]:
+        """The question and the table to decode the speakers of the response lines"""
+        numbered = list(numbered)
+        speakers = SpeakerTable(line for _, line in numbered) if self.speaker_table else SpeakerTable()
+        text = '\n'.join([f"Line {i} - {speakers.encode(line)}" for i, line in numbered])
+        return prompt.substitute(lines_per_chunk= self.chunk_lines, text= speakers.header() + text), speakers
+
+    async def _request_block(
+            self, chunk_id: str, dialogue: list[str], journal: TranslationJournal = None) -> list[str]:
+        if self.streaming:
+            return await self._stream_block(chunk_id, dialogue, journal)
+
+        question, speakers = self._question(enumerate(dialogue))
         resp = await self.llm.ask(chunk_id, question)
-        lines = [line for line in split_regex.split(resp)][1:]
+        lines = [speakers.decode(line) for line in split_regex.split(resp)][1:]
+        if self.controller:
+            self.controller.record(len(dialogue), len(lines) == len(dialogue), request_latency.get())
         if len(lines) != len(dialogue):
-            if len(dialogue) > self.chunk_lines/2:
+            aligned, broken = align_numbered(parse_numbered(resp), range(len(dialogue)))
+            aligned = {n: speakers.decode(line) for n, line in aligned.items()}
+            telemetry.record_misalignment(chunk_id, len(dialogue) - len(aligned))
+            if len(aligned) >= len(dialogue)/2: # otherwise the numbering is unreliable
+                logger.warning(f"{chunk_id}: {len(broken)} lines misaligned in the response, requesting only those")
+                try:
+                    aligned.update(await self._repair(chunk_id, dialogue, broken))
+                    telemetry.record_progress(len(dialogue))
+                    return [aligned[i] for i in range(len(dialogue))]
+                except MisalignmentException as ex:
+                    logger.warning(str(ex))
+
+            reduced_lines = max(self._chunk_lines()/2, 1)
+            if len(dialogue) > reduced_lines:
                 logger.warning(f"{chunk_id}: response lines number does not match original dialogue, retrying with reduced context")
-                return await self._split_and_translate(chunk_id, dialogue, self.chunk_lines/2)
+                telemetry.record_halving(chunk_id, len(dialogue))
+                return await self._split_and_translate(chunk_id, dialogue, reduced_lines, journal)
             else:
                 raise MisalignmentException(f"{chunk_id}: response lines number does not match original dialogue")
-        return lines
\ No newline at end of file
+        telemetry.record_progress(len(dialogue))
+        return lines
+
+    async def _stream_block(
+            self, chunk_id: str, dialogue: list[str], journal: TranslationJournal = None) -> list[str]:
+        """Translate streaming the response, when the numbering diverges the stream is aborted
+        and only the remaining lines are requested again, up to repair_attempts times. Lines still
+        missing then are split in two halves, each streamed again"""
+        received: list[str] = []
+        reported = 0 # lines received counted in the progress of the file
+        for attempt in range(self.repair_attempts + 1):
+            first = len(received)
+            parser = LineStreamParser(first, len(dialogue))
+            request_id = chunk_id if first == 0 else f"{chunk_id} from line {first}"
+            progress = first + len(dialogue)//4
+
+            question, speakers = self._question(enumerate(dialogue[first:], first))
+            stream = self.llm.ask_stream(request_id, question)
+            try:
+                async for piece in stream:
+                    parser.feed(piece)
+                    if parser.diverged:
+                        break
+                    # the last line received may still be dropped at a gap, the ones before it are final
+                    if (final := first + len(parser.lines) - 1) > reported:
+                        telemetry.record_progress(final - reported)
+                        reported = final
+                    if parser.next_line >= progress:
+                        logger.verbose(f"{request_id}: {parser.next_line}/{len(dialogue)} lines received")
+                        progress += len(dialogue)//4
+            finally:
+                await stream.aclose()
+            parser.finish()
+
+            if parser.next_line < len(dialogue) and len(parser.lines) > 1:
+                # the line before a gap may contain the missing one merged, or be truncated if the response was cut
+                parser.lines.pop()
+
+            received.extend(speakers.decode(line) for line in parser.lines)
+            telemetry.record_progress(len(received) - reported)
+            reported = len(received)
+            if self.controller and first == 0:
+                self.controller.record(len(dialogue), len(received) == len(dialogue))
+            if len(received) == len(dialogue):
+                return received
+
+            telemetry.record_misalignment(request_id, len(dialogue) - len(received))
+            if attempt < self.repair_attempts:
+                logger.warning(
+                    f"{request_id}: response diverged at line {len(received)}, "
+                    f"requesting the remaining {len(dialogue) - len(received)} lines")
+
+        remaining = dialogue[len(received):]
+        chunk_id = f"{chunk_id} from line {len(received)}" if received else chunk_id
+        if len(remaining) > 1: # halved until single lines, each smaller request streamed again
+            reduced_lines = max(len(remaining)/2, 1)
+            logger.warning(f"{chunk_id}: response lines numbering does not match original dialogue, retrying with reduced context")
+            telemetry.record_halving(chunk_id, len(remaining))
+            return received + await self._split_and_translate(chunk_id, remaining, reduced_lines, journal)
+        raise MisalignmentException(f"{chunk_id}: response lines numbering does not match original dialogue")
+
+    async def _repair(
+            self, chunk_id: str, dialogue: list[str], broken: list[int]) -> dict[int, str]:
+        """Request again only the broken lines, with a few surrounding lines as context"""
+        repaired: dict[int, str] = {}
+        for attempt in range(self.repair_attempts):
+            numbers = with_context(broken, self.repair_context, len(dialogue))
+            question, speakers = self._question((i, dialogue[i]) for i in numbers)
+            resp = await self.llm.ask(f"{chunk_id} repair {attempt + 1}", question)
+            aligned, _ = align_numbered(parse_numbered(resp), numbers)
+            repaired.update((n, speakers.decode(aligned[n])) for n in broken if n in aligned)
+            broken = [n for n in broken if n not in aligned]
+            if not broken:
+                return repaired
+        raise MisalignmentException(f"{chunk_id}: could not repair {len(broken)} misaligned lines")
@@ -0,0 +1,114 @@
+from math import ceil
+from itertools import accumulate
+from typing import Sequence
+
+from src.models import ModelLimits
+from src.token_estimator import TokenEstimator, Calibration
+
+# default limits of the models, prefixes match the dated and preview versions too
+model_limits: dict[str, ModelLimits] = {
+    "gemini-2.0-flash-lite": ModelLimits(input_tokens=1048576, output_tokens=8192),
+    "gemini-2.0-flash": ModelLimits(input_tokens=1048576, output_tokens=8192),
+    "gemini-2.5-flash-lite": ModelLimits(input_tokens=1048576, output_tokens=65536),
+    "gemini-2.5-flash": ModelLimits(input_tokens=1048576, output_tokens=65536),
+    "gemini-2.5-pro": ModelLimits(input_tokens=1048576, output_tokens=65536),
+}
+
+def limits_for(model: str, overrides: dict[str, ModelLimits] = None) -> ModelLimits:
+    """Limits of the model from the overrides, or else the defaults, matching the longest prefix"""
+    for table in (overrides or {}, model_limits):
+        prefixes = [name for name in table if model.startswith(name)]
+        if prefixes:
+            return table[max(prefixes, key=len)]
+    return ModelLimits()
+
+
+class TokenChunker:
+    """Split the dialogue in chunks as large as the model input and output limits allow.
+
+    Tokens are estimated per line with the ratios of the estimator, which are calibrated while
+    requests complete, plus `line_overhead` characters for the line markup of the translator.
+    Only `fill` of the limits is used, leaving room for estimate errors and thinking tokens.
+    Chunks are also capped at `max_lines` lines, so with large limits the split falls back to
+    splitting by line count.
+    """
+
+    def __init__(
+            self,
+            limits: ModelLimits,
+            estimator: TokenEstimator = None,
+            prompt_chars: int = 0,
+            line_overhead: int = 12,
+            fill: float = 0.8):
+        self.limits = limits
+        self.estimator = estimator
+        self.prompt_chars = prompt_chars
+        self.line_overhead = line_overhead
+        self.fill = fill
+
+    @property
+    def calibration(self) -> Calibration:
+        return self.estimator.calibration if self.estimator else Calibration()
+
+    def _cost(self, line: str) -> float:
+        """Fraction of a request used by the line, by its input or output tokens whichever is larger"""
+        c = self.calibration
+        chars = len(line) + self.line_overhead
+        input_budget = self.limits.input_tokens * self.fill - self.prompt_chars * c.input_ratio
+        output_budget = self.limits.output_tokens * self.fill
+        return max(chars * c.input_ratio / max(input_budget, 1), chars * c.output_ratio / output_budget)
+
+    def split(self, lines: Sequence[str], max_lines: int) -> list[list[str]]:
+        sizes = self.partition([self._cost(line) for line in lines], max_lines)
+        bounds = [0, *accumulate(sizes)]
+        return [list(lines[a:b]) for a, b in zip(bounds, bounds[1:])]
+
+    def cost(self, lines: Sequence[str]) -> float:
+        return sum(self._cost(line) for line in lines)
+
+    @staticmethod
+    def partition(costs: list[float], max_items: int) -> list[int]:
+        """Sizes of the consecutive groups of items, each costing at most 1 and with at most max_items items.
+
+        The number of groups is the one of a greedy packing, the items are then spread evenly by cost
+        between them, so that the last group is not left almost empty.
+        """
+        if not costs:
+            return []
+        max_items = max(int(max_items), 1)
+
+        greedy: list[int] = []
+        size, total = 0, 0.0
+        for cost in costs:
+            if size and (size == max_items or total + cost > 1):
+                greedy.append(size)
+                size, total = 0, 0.0
+            size += 1
+            total += cost
+        greedy.append(size)
+
+        groups = max(len(greedy), ceil(len(costs)/max_items))
+        target = sum(costs) / groups
+        balanced: list[int] = []
+        size, cumulative = 0, 0.0
+        for i, cost in enumerate(costs):
+            remaining_groups = groups - len(balanced) - 1
+            if size and remaining_groups > 0 and (
+                    cumulative + cost / 2 > target * (len(balanced) + 1)
+                    or len(costs) - i <= remaining_groups): # leave at least an item per group
+                balanced.append(size)
+                size = 0
+            size += 1
+            cumulative += cost
+        balanced.append(size)
+
+        q, r = divmod(len(costs), groups)
+        even = [q + (i < r) for i in range(groups)] # as the line count split
+
+        def fits(sizes: list[int]) -> bool:
+            bounds = [0, *accumulate(sizes)]
+            return len(sizes) == groups and all(
+                b - a <= max_items and (b - a == 1 or sum(costs[a:b]) <= 1)
+                for a, b in zip(bounds, bounds[1:]))
+
+        return next((sizes for sizes in (balanced, even) if fits(sizes)), greedy)
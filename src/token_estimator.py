@@ -0,0 +1,92 @@
+import asyncio
+
+from dataclasses import dataclass, asdict
+
+from src.gemini import GeminiClient
+from src.models import TokenUsage
+from src.keyed_json import load_keyed, save_keyed
+import src.logger as logger
+
+@dataclass
+class Calibration:
+    input_ratio: float = 0.5 # input tokens per character of the question, prompt included unless cached
+    output_ratio: float = 0.55 # output tokens per character of the question without prompt
+    samples: int = 0
+
+class TokenEstimator:
+    """Estimates the tokens a request will consume from the question length.
+
+    Ratios are calibrated with the usage metadata of completed requests, separately for each key
+    (model and language pair), and optionally persisted to a json file to be reused across runs.
+    Tokens of a cached prompt are known exactly and weighted by `cached_weight`, as they may count
+    differently towards the rate limits.
+    """
+
+    def __init__(
+            self,
+            client: GeminiClient,
+            key: str = None,
+            path: str = None,
+            smoothing: float = 0.2,
+            cached_weight: float = 1.0):
+        self.client = client
+        self.key = key or client.model
+        self.path = path
+        self.smoothing = smoothing
+        self.cached_weight = cached_weight
+
+        self._calibrations = {k: Calibration(**v) for k, v in load_keyed(path).items()}
+        self.calibration = self._calibrations.setdefault(self.key, Calibration())
+        self._seed_lock = asyncio.Lock()
+        self._seed_attempted = False
+
+    @property
+    def seeded(self) -> bool:
+        return self._seed_attempted or self.calibration.samples > 0
+
+    def _uncached_length(self, question: str) -> int:
+        if self.client.cached_prompt_tokens:
+            return len(question)
+        return len(self.client.prompt) + 1 + len(question)
+
+    def estimate(self, question: str) -> int:
+        return int(
+            self._uncached_length(question) * self.calibration.input_ratio
+            + len(question) * self.calibration.output_ratio
+            + self.client.cached_prompt_tokens * self.cached_weight)
+
+    def charged(self, usage: TokenUsage) -> int:
+        """Tokens of a completed request counted towards the rate limits"""
+        return int(usage.total - usage.cached_tokens * (1 - self.cached_weight))
+
+    async def seed(self, question: str):
+        """Calibrate the input ratio with an exact token count, only once and only when no calibration is available"""
+        async with self._seed_lock:
+            if self.seeded:
+                return
+            self._seed_attempted = True
+            try:
+                tokens = await self.client.compute_question_tokens(question)
+            except Exception as ex:
+                logger.debug(f"Could not count tokens to seed estimates: {ex}")
+                return
+            if self.calibration.samples == 0: # a request may have completed meanwhile
+                self.calibration.input_ratio = tokens / self._uncached_length(question)
+                logger.debug(f"{self.key}: input tokens estimate seeded at {self.calibration.input_ratio:.3f} per char")
+
+    def update(self, question: str, usage: TokenUsage):
+        if usage is None or not question:
+            return
+        input_ratio = (usage.prompt_tokens - usage.cached_tokens) / self._uncached_length(question)
+        output_ratio = usage.output_tokens / len(question)
+        c = self.calibration
+        # first sample replaces the default ratios, following ones are smoothed
+        alpha = 1 if c.samples == 0 else self.smoothing
+        c.input_ratio += alpha * (input_ratio - c.input_ratio)
+        c.output_ratio += alpha * (output_ratio - c.output_ratio)
+        c.samples += 1
+
+    def save(self):
+        """Save the calibration under this estimator key"""
+        if self.path:
+            save_keyed(self.path, self.key, asdict(self.calibration))
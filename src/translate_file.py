@@ -1,11 +1,93 @@
 import os
+import time
 import asyncio
 
+from concurrent.futures import Executor
+
 from src.models import *
 from src.srt_parser import SrtTranslationFile
 from src.ass_parser import AssTranslationFile
+from src.dedup import DialogueDedup
+from src.manifest import TranslationManifest, manifest_path, line_hashes
+from src.telemetry import FileInfo, current_file
 
 import src.logger as logger
+import src.telemetry as telemetry
+
+def parse_file(file_path: str, ass_settings: AssSettings) -> TranslationFile:
+    with open(file_path, 'r', encoding='utf-8') as fp:
+        if file_path.endswith('.ass'):
+            return AssTranslationFile(fp.read(), ass_settings)
+        return SrtTranslationFile(fp.read())
+
+def load_previous(out_path: str, ass_settings: AssSettings) -> dict[str, str]:
+    """Map the hashes of the source lines of the existing translation to their translated text,
+    empty if there is no translation or it does not match its manifest"""
+    manifest = TranslationManifest.load(manifest_path(out_path))
+    if manifest is None or not os.path.exists(out_path):
+        return {}
+    texts = parse_file(out_path, ass_settings).get_texts()
+    if len(texts) != len(manifest.lines): # edited, or lines left blank by the translation
+        logger.warning(f"{out_path} does not match its manifest, translating the whole file again")
+        return {}
+    return dict(zip(manifest.lines, texts))
+
+def load_file(
+        file_path: str,
+        ass_settings: AssSettings,
+        dedup_lines: bool,
+        out_path: str = None) -> tuple[TranslationFile, TranslationManifest, list[Optional[str]], DialogueDedup]:
+    """Read and parse a subtitle file, a module function so that it can run in a worker process.
+
+    With out_path, the manifest of the file is built and the translated text of the lines unchanged
+    since the existing translation is returned, None for the lines to translate.
+    """
+    manifest = kept = None
+    if out_path:
+        manifest = TranslationManifest.of_file(file_path) # before reading, a later change is seen next run
+    sub_file = parse_file(file_path, ass_settings)
+    dialogue = sub_file.get_dialogue()
+    if manifest:
+        manifest.lines = line_hashes(sub_file.get_texts())
+        previous = load_previous(out_path, ass_settings)
+        kept = [previous.get(h) for h in manifest.lines]
+        if any(text is not None for text in kept):
+            dialogue = [line for line, text in zip(dialogue, kept) if text is None]
+        else:
+            kept = None
+    # repeated lines, like layered signs and song lines, are translated once
+    return sub_file, manifest, kept, DialogueDedup(dialogue) if dedup_lines else None
+
+def write_file(
+        out_path: str,
+        sub_file: TranslationFile,
+        translation: list[str],
+        dedup: DialogueDedup = None,
+        manifest: TranslationManifest = None,
+        kept: list[Optional[str]] = None):
+    """Write the translated file, expanding the repeated lines translated once and merging the
+    lines kept from the previous translation"""
+    if dedup:
+        translation = dedup.expand(translation)
+    if kept:
+        lines = iter(translation)
+        translation = [next(lines) if text is None else None for text in kept]
+    if manifest and os.path.exists(manifest_path(out_path)):
+        os.remove(manifest_path(out_path)) # a stale manifest must not outlive an interrupted write
+    with open(out_path, 'w+', encoding='utf-8') as fp:
+        sub_file.write_translation(translation, fp, kept)
+    if manifest:
+        manifest.save(manifest_path(out_path))
+
+def contiguous_ranges(indices: list[int]) -> list[tuple[int, int]]:
+    """Split sorted indices into ranges of consecutive ones, end excluded"""
+    ranges = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i:
+            ranges[-1] = (ranges[-1][0], i + 1)
+        else:
+            ranges.append((i, i + 1))
+    return ranges
 
 class TranslateFileTask:
 
@@ -13,30 +95,71 @@ class TranslateFileTask:
             translator: Translator,
             file_path: str,
             out_path: str,
-            ass_settings: AssSettings):
+            ass_settings: AssSettings,
+            resume_journal: bool = False,
+            dedup_lines: bool = False,
+            manifest: bool = False,
+            executor: Executor = None,
+            order: int = 0):
         self.translator = translator
         self.file_path = file_path
         self.out_path = out_path
         self.ass_settings = ass_settings
+        self.resume_journal = resume_journal
+        self.dedup_lines = dedup_lines
+        self.manifest = manifest # retranslate only the changed lines of a file translated before
+        self.executor = executor # reads, parses and writes files off the event loop, if set
+        self.order = order # position in the run, for the scheduling of the requests
         _, self.filename = os.path.split(self.file_path)
 
-    def _load_file(self) -> TranslationFile:
-        with open(self.file_path, 'r', encoding='utf-8') as fp:
-            if self.file_path.endswith('.ass'):
-                return AssTranslationFile(fp.read(), self.ass_settings)
-            else:
-                return SrtTranslationFile(fp.read())
+    async def _run(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
 
     async def __call__(self):
-        sub_file = self._load_file()
+        sub_file, manifest, kept, dedup = await self._run(
+            load_file, self.file_path, self.ass_settings, self.dedup_lines, self.out_path if self.manifest else None)
         dialogue = sub_file.get_dialogue()
-        translation = await self.translator(self.filename, dialogue)
 
-        translated = sub_file.get_translation(translation.dialogue)
+        changed = None
+        if kept:
+            changed = [i for i, text in enumerate(kept) if text is None]
+            dialogue = [dialogue[i] for i in changed]
+            logger.info(
+                f"{self.filename}: {len(changed)} new or changed lines to translate,"
+                f" {len(kept) - len(changed)} kept from {self.out_path}")
+
+        if dedup:
+            dialogue = dedup.unique
+            if dedup.duplicates:
+                logger.info(f"{self.filename}: {dedup.duplicates} repeated lines translated once")
+
+        info = FileInfo(self.order, len(dialogue), time.monotonic(), self.file_path)
+        current_file.set(info)
+        telemetry.file_started(info)
+
+        # translated blocks are journaled next to the output until the file is completed
+        journal = await self._run(TranslationJournal, self.out_path + '.journal') if self.resume_journal else None
+        if journal and journal.resumed:
+            logger.info(f"{self.filename}: resuming {journal.resumed} translated blocks from previous run")
+        try:
+            if dialogue:
+                translation = await self.translator(self.filename, dialogue, journal)
+            else: # only the timings or the ignored lines changed
+                translation = TranslationOutput(self.filename, [])
+        finally:
+            if journal: journal.close()
 
+        unresolved = 0
         if translation.misalignments:
-            misalignments = sub_file.map_dialogue_lines(
-                [x for a, b in translation.misalignments for x in (a, b)])
+            ranges = dedup.expand_ranges(translation.misalignments) if dedup else translation.misalignments
+            if changed: # ranges end excluded, of the changed lines
+                ranges = [r for a, b in ranges for r in contiguous_ranges(changed[a:b])]
+            unresolved = sum(b - a for a, b in ranges)
+            if manifest: # padded with the source text, translated again next run
+                manifest.mark_untranslated(ranges)
+            misalignments = sub_file.map_dialogue_lines([x for a, b in ranges for x in (a, b)])
 
             misalignments_warnings = [
                 f"{misalignments[i]}-{misalignments[i+1]}"
@@ -47,7 +170,8 @@ class TranslateFileTask:
                     f"{self.filename} - misilignments at lines [{', '.join(misalignments_warnings)}]",
                     save=True)
 
-        with open(self.out_path, 'w+', encoding='utf-8') as fp:
-            fp.write(translated)
+        await self._run(write_file, self.out_path, sub_file, translation.dialogue, dedup, manifest, kept)
+        if journal: journal.remove()
+        telemetry.file_finished(self.order, self.file_path, unresolved_lines=unresolved)
 
         logger.success(f"{self.filename}: Generated {self.out_path}", save=True)
\ No newline at end of file
@@ -0,0 +1,152 @@
+import re
+import sqlite3
+import hashlib
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, Callable, Awaitable
+
+from src.models import MemorySettings
+from src.dedup import DialogueDedup, token_regex
+import src.logger as logger
+
+placeholder_regex = re.compile(r'\{#(\d+)\}') # token of a stored translation, by position in its source
+
+
+class TranslationMemory:
+    """On-disk cache of translated dialogue lines.
+
+    Entries are keyed by the source line and a namespace hashing everything that can change
+    the translation (language pair, model, prompts, request template), so a change in any of them never
+    serves stale lines. Lines are keyed normalized as by DialogueDedup, so that the same sign or song line
+    hits across files with other tags or format numbering, and served with their own tokens.
+    Lookups and stores run in a worker thread of their own, to keep the event loop serving the requests.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            namespace: Iterable[str],
+            max_entries: int = None,
+            max_age_days: float = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days is not None else None
+
+        h = hashlib.sha256()
+        for part in namespace:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        self._namespace = h.hexdigest()
+
+        # the connection is only used by the single worker, and by close once it is idle
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='translation_memory')
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS memory ("
+            "key TEXT PRIMARY KEY, translation TEXT NOT NULL, last_used REAL NOT NULL)")
+        self._db.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self._used: dict[str, float] = {} # last use of the lines served, written with the next store
+        self.evict()
+
+    @classmethod
+    def from_settings(cls, settings: MemorySettings, namespace: Iterable[str]) -> 'TranslationMemory':
+        return cls(settings.path, namespace, settings.max_entries, settings.max_age_days)
+
+    def _key(self, line: str) -> str:
+        return hashlib.sha256(f"{self._namespace}\0{DialogueDedup.normalize(line)}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _detoken(source: str, translation: str) -> str:
+        """Replace the tokens of the source in its translation with their position in the source"""
+        positions: dict[str, int] = {}
+        for i, token in enumerate(token_regex.findall(source)):
+            positions.setdefault(token, i)
+        return token_regex.sub(
+            lambda m: f"{{#{positions[m.group(0)]}}}" if m.group(0) in positions else m.group(0), translation)
+
+    @staticmethod
+    def _retoken(line: str, translation: str) -> str:
+        """Replace the token positions of a stored translation with the tokens of line"""
+        tokens = token_regex.findall(line)
+        return placeholder_regex.sub(
+            lambda m: tokens[int(m.group(1))] if int(m.group(1)) < len(tokens) else m.group(0), translation)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def lookup(self, lines: list[str]) -> list[Optional[str]]:
+        """Return the cached translation of each line, None where missing"""
+        return await self._run(self._lookup, lines)
+
+    async def store(self, pairs: Iterable[tuple[str, str]]):
+        await self._run(self._store, list(pairs))
+
+    def _lookup(self, lines: list[str]) -> list[Optional[str]]:
+        keys = [self._key(l) for l in lines]
+        found: dict[str, str] = {}
+        for i in range(0, len(keys), 500): # stay below sqlite max variables
+            batch = keys[i: i + 500]
+            rows = self._db.execute(
+                f"SELECT key, translation FROM memory WHERE key IN ({','.join('?'*len(batch))})", batch)
+            found.update(rows)
+
+        now = time.time()
+        for k in found:
+            self._used[k] = now
+
+        result = [self._retoken(l, found[k]) if k in found else None for l, k in zip(lines, keys)]
+        hits = sum(1 for t in result if t is not None)
+        self.hits += hits
+        self.misses += len(result) - hits
+        return result
+
+    def _write_used(self):
+        if self._used:
+            self._db.executemany(
+                "UPDATE memory SET last_used = ? WHERE key = ?", [(t, k) for k, t in self._used.items()])
+            self._used.clear()
+
+    def _store(self, pairs: list[tuple[str, str]]):
+        now = time.time()
+        self._write_used()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO memory (key, translation, last_used) VALUES (?, ?, ?)",
+            [(self._key(source), self._detoken(source, translation), now) for source, translation in pairs])
+        self._db.commit()
+
+    async def serve(
+            self,
+            dialogue: list[str],
+            translate: Callable[[list[str]], Awaitable[list[str]]]) -> list[str]:
+        """Translate dialogue sending only the lines missing from memory to translate"""
+        result = await self.lookup(dialogue)
+        missing = [i for i, t in enumerate(result) if t is None]
+        if missing:
+            sources = [dialogue[i] for i in missing]
+            translated = await translate(sources)
+            await self.store(zip(sources, translated))
+            for i, line in zip(missing, translated):
+                result[i] = line
+        return result
+
+    def evict(self):
+        self._write_used()
+        if self.max_age is not None:
+            self._db.execute("DELETE FROM memory WHERE last_used < ?", (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            self._db.execute(
+                "DELETE FROM memory WHERE key NOT IN "
+                "(SELECT key FROM memory ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+        self._db.commit()
+
+    def close(self):
+        self._executor.shutdown()
+        self.evict()
+        self._db.close()
+        if self.hits:
+            logger.info(f"Translation memory: {self.hits} lines served from cache, {self.misses} translated")
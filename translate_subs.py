@@ -1,51 +1,197 @@
 import os
 import sys
 import asyncio
-import glob
+import itertools
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 from string import Template
+from typing import Iterable
 
 from src.models import *
 from src.gemini import GeminiClient
 from src.rate_limiter import RateLimitedLLM
+from src.llm_pool import LLMPool
+from src.scheduler import RequestScheduler
+from src.token_estimator import TokenEstimator
+from src.token_chunker import TokenChunker, limits_for
+from src.chunk_controller import ChunkSizeController
+from src.translation_memory import TranslationMemory
 from src.translate_file import TranslateFileTask
+from src.discovery import translated_path, discover_files
+from src.dashboard import Dashboard
 
 import src.logger as logger
-
-def translated_path(file_path: str, suffix: str) -> str:
-    path, file = os.path.split(file_path)
-    filename, ext = os.path.splitext(file)
-    out_file_name = f'{filename}{suffix}{ext}'
-    full_path = os.path.join(path, out_file_name)
-    return full_path
+import src.telemetry as telemetry
 
 async def translate_file(task: TranslateFileTask, semaphore: asyncio.Semaphore):
-    async with semaphore: # avoid files being loded all at once
-        try:
-            await task()
-        except Exception as ex:
-            logger.error(f"{task.filename} failed: {ex}", save=True)
-            logger.debug(traceback.format_exc())
-
-async def main(llm: RateLimitedLLM, file_paths: list[str], config: Config):
-    semaphore = asyncio.Semaphore(config.max_concurrent_requests or config.requests_per_minutes)
+    try: # the slot was acquired by main before creating the task
+        await task()
+    except Exception as ex:
+        logger.error(f"{task.filename} failed: {ex}", save=True)
+        logger.debug(traceback.format_exc())
+        telemetry.file_finished(task.order, task.file_path, "failed")
+    finally:
+        semaphore.release()
+
+def build_llm(key: str, prompt: str, config: Config) -> RateLimitedLLM | LLMPool:
+    def rate_limited(key: str, model: str, rpm: int, tpm: int, max_concurrent: int, max_retries: int):
+        # each backend backs off on its own quota errors
+        client = GeminiClient(
+            key=key,
+            model=model,
+            prompt=prompt,
+            config=config.content_config,
+            cache_prompt=config.cache_prompt,
+            cache_ttl=config.cache_ttl_seconds
+        )
+        return RateLimitedLLM(
+            client=client,
+            requests_per_minute=rpm,
+            tokens_per_minute=tpm,
+            max_retries=max_retries,
+            max_concurrent_requests=max_concurrent,
+            estimator=TokenEstimator(
+                client,
+                key=f"{model}:{config.original_language}->{config.translate_to}",
+                path=config.token_calibration_path,
+                cached_weight=config.cached_token_weight),
+            seed_estimates=config.seed_token_estimates,
+            backoff_base=config.backoff_base_seconds,
+            backoff_max=config.backoff_max_seconds
+        )
+
+    if not config.backends:
+        return rate_limited(
+            key, config.model, config.requests_per_minutes, config.token_per_minutes,
+            config.max_concurrent_requests, config.max_retries)
+
+    backends = []
+    for backend in config.backends:
+        backend_key = key
+        if backend.key_env:
+            backend_key = os.environ[backend.key_env]
+        elif backend.key_file:
+            with open(backend.key_file, 'r') as key_fp:
+                backend_key = key_fp.read().strip()
+        backends.append(rate_limited(
+            backend_key, backend.model, backend.requests_per_minutes, backend.token_per_minutes,
+            backend.max_concurrent_requests, max_retries=0))
+    return LLMPool(backends, config.max_retries)
+
+def translator_template(config: Config) -> str:
+    """Template of the requests of the configured translator"""
+    if config.translator_type == 'json':
+        from src.json_translator.translator import prompt, compact_prompt
+        return (compact_prompt if config.json_format == 'compact' else prompt).template
+    from src.text_translator.translator import prompt
+    return prompt.template
+
+async def main(llm: RateLimitedLLM | LLMPool, file_paths: Iterable[str], config: Config):
+    telemetry.start(config.telemetry_path)
+    concurrency = (
+        config.max_concurrent_requests
+        or sum(b.requests_per_minutes for b in config.backends)
+        or config.requests_per_minutes)
+    # the requests of the open files are sent in the order of the scheduling policy, not file by file
+    semaphore = asyncio.Semaphore(config.max_open_files or 2 * concurrency)
+
+    memory = None
+    if config.translation_memory:
+        memory = TranslationMemory.from_settings(
+            config.translation_memory,
+            namespace=(
+                config.original_language, config.translate_to, config.translator_type,
+                llm.model, llm.prompt, translator_template(config)))
+
+    chunker = None
+    if config.token_chunking:
+        # requests must fit the backend with the smallest limits, with its calibrated estimates
+        backends = llm.backends if isinstance(llm, LLMPool) else [llm]
+        limits = {b: limits_for(b.model, config.model_limits) for b in backends}
+        tightest = min(backends, key=lambda b: limits[b].output_tokens)
+        chunker = TokenChunker(
+            limits[tightest], tightest.estimator, prompt_chars=len(llm.prompt), fill=config.chunk_token_fill,
+            line_overhead=4 if config.translator_type == 'json' and config.json_format == 'compact' else 12)
+
+    controller = None
+    if config.adaptive_chunking:
+        # tunes chunks per request for the json translator, lines per request for the text one
+        controller = ChunkSizeController(
+            config.chunks_per_request if config.translator_type == 'json' else config.lines_per_chunk,
+            key=f"{llm.model}:{config.translator_type}",
+            path=config.chunk_controller_path,
+            latency_target=config.chunk_latency_target)
+
+    scheduler = RequestScheduler(
+        llm, concurrency, config.schedule_policy, deadline_per_line=config.deadline_seconds_per_line)
 
     if config.translator_type == 'json':
         from src.json_translator.translator import JsonChunkerTranslator
-        translator = JsonChunkerTranslator(llm, config.lines_per_chunk, config.chunks_per_request)
+        translator = JsonChunkerTranslator(
+            scheduler, config.lines_per_chunk, config.chunks_per_request, memory,
+            pack_linger=config.pack_linger_seconds if config.pack_requests else None,
+            chunker=chunker, controller=controller, wire_format=config.json_format,
+            speaker_table=config.speaker_table)
     else:
         from src.text_translator.translator import TextTranslator
-        translator = TextTranslator(llm, config.lines_per_chunk)
-
+        translator = TextTranslator(
+            scheduler, config.lines_per_chunk, memory, config.streaming, chunker=chunker, controller=controller,
+            speaker_table=config.speaker_table)
+
+    # files are read, parsed and written by a few workers, to keep the event loop serving the requests
+    executor = None
+    if config.io_workers and config.io_processes:
+        executor = ProcessPoolExecutor(config.io_workers)
+    elif config.io_workers:
+        executor = ThreadPoolExecutor(config.io_workers, thread_name_prefix='file_io')
+
+    backends = llm.backends if isinstance(llm, LLMPool) else [llm]
+    dashboard = None
+    if config.dashboard and logger.console.is_terminal:
+        dashboard = Dashboard(backends, logger.console)
+        dashboard_task = asyncio.create_task(dashboard.run())
+    loop = asyncio.get_running_loop()
+    files = iter(file_paths)
     async with asyncio.TaskGroup() as tg:
-        for file_path in file_paths:
+        # files are pulled from file_paths only when a slot frees up, at most max_open_files tasks exist at once.
+        # Pulled in a worker thread, as discovery lists folders and hashes the sources of existing translations
+        for order in itertools.count():
+            file_path = await loop.run_in_executor(None, next, files, None)
+            if file_path is None:
+                break
+            await semaphore.acquire()
             out_path = translated_path(file_path, config.outfile_suffix)
-            translation_task = TranslateFileTask(translator, file_path, out_path, config.ass_settings)
+            translation_task = TranslateFileTask(
+                translator, file_path, out_path, config.ass_settings, config.resume_journal,
+                config.dedup_lines, config.manifest, executor, order)
             tg.create_task(translate_file(translation_task, semaphore))
-
+        if dashboard: dashboard.discovery_done = True
+
+    if dashboard:
+        dashboard_task.cancel()
+        await asyncio.gather(dashboard_task, return_exceptions=True)
+    if executor:
+        executor.shutdown()
+    if memory:
+        memory.close()
+    if controller:
+        controller.save()
+        logger.debug(
+            f"Request size {controller.size}, {controller.stats.failure_rate:.0%} of"
+            f" {controller.stats.requests} requests failed")
+    await llm.close()
+
+    if config.metrics_path:
+        telemetry.write_metrics(config.metrics_path, backends)
+    telemetry.close()
+
+    logger.flush()
     print('\n')
     logger.info(f'Terminated - final log:')
+    for line in telemetry.summary(backends):
+        logger.info(line, timestamped=False)
     logger.print_final_log()
 
 
@@ -56,10 +202,6 @@ if __name__ == '__main__':
             with open(os.path.join(script_path, 'gemini.key'), 'r') as key_fp:
                 key = key_fp.read()
 
-    if not key:
-        logger.error("Could not retrieve gemini key, populate env variable GEMINI_KEY or file gemini.key")
-        sys.exit()
-
     with (
             open(os.path.join(script_path, 'config.json'), 'r') as config_fp,
             open(os.path.join(script_path, 'user_prompt.md'), 'r') as user_prompt_fp,
@@ -69,40 +211,25 @@ if __name__ == '__main__':
         user_prompt = user_prompt_fp.read()
         system_prompt = Template(system_prompt_fp.read()).substitute(dict(config))
 
+    if not key and not (config.backends and all(b.key_env or b.key_file for b in config.backends)):
+        logger.error("Could not retrieve gemini key, populate env variable GEMINI_KEY or file gemini.key")
+        logger.close()
+        sys.exit(1)
+
     logger.debug_enabled = config.debug
+    logger.setup(config.log_path, config.log_max_bytes, config.log_backups, config.max_saved_logs)
     prompt = user_prompt + '\n' + system_prompt
 
-    if len(sys.argv) == 2 and os.path.isdir(sys.argv[1]):
-        folder = glob.escape(sys.argv[1])
-        file_paths = glob.glob(f'{folder}/*.ass') + glob.glob(f'{folder}/*.srt')
-    else:
-        file_paths = [f for f in sys.argv[1:] if f.endswith('.ass') or f.endswith('.srt')]
-        folder, _ = os.path.split(file_paths[0])
-        folder = glob.escape(folder)
+    # files are discovered lazily while translating, one folder at a time
+    to_translate = discover_files(sys.argv[1:], config.outfile_suffix, config.recursive, config.manifest)
+    first = next(to_translate, None)
 
-    translated = glob.glob(f'{folder}/*{config.outfile_suffix}.ass') + glob.glob(f'{folder}/*{config.outfile_suffix}.srt')
-
-    to_translate = [f for f in file_paths
-                    if not f[:-4].endswith(f'{config.outfile_suffix}')
-                    and translated_path(f, config.outfile_suffix) not in translated]
-
-    if not to_translate:
+    if first is None:
         logger.warning("Found no file to translate, already translated files are ignored.")
+        logger.close()
         sys.exit()
 
-    client = GeminiClient(
-        key=key,
-        model=config.model,
-        prompt=prompt,
-        config=config.content_config
-    )
-
-    queue = RateLimitedLLM(
-        client=client,
-        requests_per_minute=config.requests_per_minutes,
-        tokens_per_minute=config.token_per_minutes,
-        max_retries=config.max_retries,
-        max_concurrent_requests=config.max_concurrent_requests
-    )
-
-    asyncio.run(main(queue, to_translate, config))
\ No newline at end of file
+    queue = build_llm(key, prompt, config)
+
+    asyncio.run(main(queue, itertools.chain([first], to_translate), config))
+    logger.close()
\ No newline at end of file